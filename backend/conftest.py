@@ -1,4 +1,5 @@
 import pytest
+from django.core.cache import cache
 
 from backend.users.models import User
 from backend.users.tests.factories import UserFactory
@@ -12,3 +13,10 @@ def media_storage(settings, tmpdir):
 @pytest.fixture
 def user(db) -> User:
     return UserFactory()
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Индексы поиска в кэше ссылаются на id, которые откатываются вместе с тестом
+    yield
+    cache.clear()
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib import admin
 
 from backend.orders.models import (
@@ -8,6 +9,7 @@ from backend.orders.models import (
     Product,
     TradePoint,
 )
+from backend.orders.tasks import reparse_customer_orders
 
 
 @admin.register(Customer)
@@ -49,5 +51,14 @@ class OrderAdmin(admin.ModelAdmin):
 
 @admin.register(CustomerOrder)
 class CustomerOrderAdmin(admin.ModelAdmin):
-    list_display = ("id", "customer", "file", "created")
-    list_filter = ("customer",)
+    list_display = ("id", "customer", "file", "status", "lines_count", "created")
+    list_filter = ("customer", "status")
+    actions = ("reparse",)
+
+    @admin.action(description="Повторно разобрать файлы заказов")
+    def reparse(self, request, queryset):
+        ids, skipped = reparse_customer_orders(queryset, lanes=settings.ORDER_REPARSE_LANES)
+        message = f"В очереди на повторный разбор {len(ids)} заказов."
+        if skipped:
+            message += f" Пропущено заказов, которые ещё ждут разбора или разбираются: {skipped}."
+        self.message_user(request, message)
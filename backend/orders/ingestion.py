@@ -0,0 +1,523 @@
+"""
+Пакетная запись распарсенных заказов в БД.
+
+Парсеры приводят файл клиента к плоской таблице строк заказа
+(торговая точка, товар, количество) и передают её в ``OrderIngestor``.
+Торговые точки и товары клиента резолвятся по индексу клиента из кэша
+(см. ``backend.orders.lookups``), недостающие создаются через ``bulk_create``,
+а ``Order`` и ``ProductInOrder`` пишутся через ``bulk_insert`` (``COPY`` в
+PostgreSQL), поэтому число запросов не зависит от размера файла.
+"""
+from collections import Counter, defaultdict
+from collections.abc import Iterable
+from typing import Any
+
+import pandas as pd
+from django.db import connection, models, transaction
+
+from backend.orders.lookups import invalidate_index, load_index, lock_customer
+from backend.orders.models import (
+    Customer,
+    CustomerOrder,
+    CustomerProduct,
+    Order,
+    ProductInOrder,
+    StagedProductInOrder,
+    TradePoint,
+)
+
+# Колонки таблицы строк заказа, которую формируют парсеры
+TRADE_POINT = "trade_point"
+SAPCODE = "sapcode"
+PRODUCT = "product"
+VENDOR_CODE = "vendor_code"
+AMOUNT = "amount"
+
+LINE_COLUMNS = [TRADE_POINT, SAPCODE, PRODUCT, VENDOR_CODE, AMOUNT]
+
+# Схема таблицы строк: ключи повторяются на каждой строке, поэтому хранятся
+# категориями, а количества - целыми int32 вместо object
+LINE_DTYPES = {
+    TRADE_POINT: "category",
+    SAPCODE: "category",
+    PRODUCT: "category",
+    VENDOR_CODE: "category",
+    AMOUNT: "int32",
+}
+
+# Соответствие полей моделей колонкам таблицы строк
+TRADE_POINT_FIELDS = {"name": TRADE_POINT, "sapcode": SAPCODE}
+PRODUCT_FIELDS = {"name": PRODUCT, "vendor_code": VENDOR_CODE}
+
+# Колонки строк заказа после резолва торговых точек и товаров
+RESOLVED_COLUMNS = ["trade_point_id", "product_id", AMOUNT]
+
+BATCH_SIZE = 1000
+
+
+def make_lines(rows: Iterable[dict]) -> pd.DataFrame:
+    """Собирает таблицу строк заказа из словарей, дополняя необязательные колонки."""
+    # object, чтобы числовые артикулы с пропусками не превращались во float
+    lines = pd.DataFrame(list(rows), columns=LINE_COLUMNS, dtype=object)
+    return normalize_lines(lines)
+
+
+def melt_lines(df: pd.DataFrame, id_columns: dict, trade_points: dict[Any, dict]) -> pd.DataFrame:
+    """
+    Разворачивает "широкую" таблицу (товары в строках, торговые точки в колонках)
+    в таблицу строк заказа без построчного обхода.
+
+    ``id_columns`` - соответствие колонок файла колонкам строк (``PRODUCT``,
+    ``VENDOR_CODE``), ``trade_points`` - соответствие колонки файла с
+    количествами значениям торговой точки (``TRADE_POINT``, ``SAPCODE``).
+    """
+    lines = df.melt(
+        id_vars=list(id_columns),
+        value_vars=list(trade_points),
+        var_name="_column",
+        value_name=AMOUNT,
+    )
+    lines = lines.rename(columns=id_columns)
+    lines = lines.join(pd.DataFrame.from_dict(trade_points, orient="index"), on="_column")
+    return normalize_lines(lines)
+
+
+def bulk_insert(model: type[models.Model], fields: list[str], rows: Iterable[tuple], batch_size: int = BATCH_SIZE):
+    """
+    Вставляет строки значений ``fields`` в таблицу модели. В PostgreSQL строки
+    потоком уходят в ``COPY ... FROM STDIN`` (psycopg 3), на других базах
+    пишутся через ``bulk_create``. Как и ``bulk_create``, сигналы не отправляет.
+    """
+    if connection.vendor != "postgresql":
+        model._default_manager.bulk_create((model(**dict(zip(fields, row))) for row in rows), batch_size=batch_size)
+        return
+
+    from psycopg import sql
+
+    # Поля задаются как в конструкторе модели (``order_id``), колонки берутся из описания полей
+    columns = {field.attname: field.column for field in model._meta.fields}
+    statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(model._meta.db_table),
+        sql.SQL(", ").join(sql.Identifier(columns[field]) for field in fields),
+    )
+    with connection.cursor() as cursor, cursor.cursor.copy(statement) as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+def normalize_lines(lines: pd.DataFrame) -> pd.DataFrame:
+    """Приводит таблицу строк к схеме ``LINE_DTYPES``: все колонки на месте, ключи строковые, количество целое."""
+    lines = lines.reindex(columns=LINE_COLUMNS)
+    # Значения сравниваются с CharField, поэтому приводятся к строкам так же, как это делает Django
+    for column in (TRADE_POINT, SAPCODE, PRODUCT):
+        lines[column] = lines[column].astype(object).fillna("").astype(str)
+    vendor_codes = lines[VENDOR_CODE].astype(object)
+    lines[VENDOR_CODE] = vendor_codes.astype(str).where(vendor_codes.notna(), None)
+    lines[AMOUNT] = to_quantities(lines[AMOUNT])
+    return lines.astype(LINE_DTYPES)
+
+
+def to_quantities(values: pd.Series | pd.DataFrame) -> pd.Series | pd.DataFrame:
+    """Приводит количества к int32; пустые и нечисловые значения считаются нулём."""
+    if isinstance(values, pd.DataFrame):
+        return values.apply(to_quantities)
+    return pd.to_numeric(values, errors="coerce").fillna(0).astype(LINE_DTYPES[AMOUNT])
+
+
+def _plain(frame: pd.DataFrame) -> pd.DataFrame:
+    """Переводит категории в обычные значения Python (``None`` вместо NaN) для ORM и ключей словарей."""
+    frame = frame.astype(object)
+    return frame.where(frame.notna(), None)
+
+
+class OrderIngestor:
+    """
+    Записывает строки заказа в рамках одного ``CustomerOrder``.
+
+    ``trade_point_key`` - поле, по которому ищется существующая торговая точка
+    (``name`` или ``sapcode``), ``product_key`` - поля, по которым ищется товар
+    клиента. Недостающие объекты создаются со всеми значениями из строки.
+    С ``attach_listed_products`` к общему заказу привязываются все товары
+    файла, в том числе с нулевым количеством, иначе - только заказанные.
+    Состояние (созданные заказы, привязанные товары) сохраняется между вызовами
+    ``ingest``, так что файл можно передавать частями, в том числе продолжая
+    прерванный разбор.
+    """
+
+    def __init__(
+        self,
+        customer_order: CustomerOrder,
+        trade_point_key: str = "name",
+        product_key: tuple[str, ...] = ("name", "vendor_code"),
+        batch_size: int = BATCH_SIZE,
+        attach_listed_products: bool = False,
+    ):
+        self.customer_order = customer_order
+        self.customer = customer_order.customer
+        self.trade_point_key = trade_point_key
+        self.product_key = product_key
+        self.batch_size = batch_size
+        self.attach_listed_products = attach_listed_products
+        # Товары всех строк файла, переданных в resolve
+        self.listed_products: set[int] = set()
+        # Заказы и товары, уже записанные в customer_order. Если разбор
+        # продолжает прерванный (checkpoint > 0), они читаются из БД при первой записи
+        resumed = customer_order.checkpoint > 0
+        self._orders: dict[int, int] | None = None if resumed else {}
+        self._attached_products: set[int] | None = None if resumed else set()
+        # Индексы поиска загружаются из кэша один раз на загрузку файла
+        self._trade_points: dict | None = None
+        self._products: dict | None = None
+        # Сколько секунд разбор ждал блокировки клиента (см. lock_customer)
+        self.lock_wait = 0.0
+        self._locked = False
+
+    @property
+    def _trade_point_column(self) -> str:
+        return TRADE_POINT_FIELDS[self.trade_point_key]
+
+    @property
+    def _product_columns(self) -> list[str]:
+        return [PRODUCT_FIELDS[field] for field in self.product_key]
+
+    def ingest(self, lines: pd.DataFrame) -> int:
+        """
+        Резолвит торговые точки и товары всех строк, а для строк с ненулевым
+        количеством создаёт заказы и товары в заказе. Возвращает число
+        записанных строк.
+        """
+        ordered = self.resolve(lines)
+        if not ordered.empty:
+            self._write(ordered)
+        if self.attach_listed_products:
+            self._attach_products(self.listed_products)
+        return len(ordered)
+
+    def resolve(self, lines: pd.DataFrame) -> pd.DataFrame:
+        """
+        Резолвит торговые точки и товары всех строк, создавая недостающие, и
+        возвращает строки с ненулевым количеством в виде ``RESOLVED_COLUMNS``.
+        """
+        if lines.empty:
+            return pd.DataFrame(columns=RESOLVED_COLUMNS)
+        # Блокировка транзакционная: вызов resolve обычно идёт в своей транзакции
+        self._locked = False
+        trade_points = self._resolve_trade_points(lines)
+        products = self._resolve_products(lines)
+        self.listed_products.update(products["product_id"].tolist())
+
+        ordered = lines.loc[lines[AMOUNT] > 0]
+        keys = [self._trade_point_column, *self._product_columns]
+        ordered = pd.concat([_plain(ordered[keys]), ordered[AMOUNT]], axis=1)
+        ordered = ordered.merge(trade_points, on=self._trade_point_column, how="left").merge(
+            products, on=self._product_columns, how="left"
+        )
+        return ordered[RESOLVED_COLUMNS]
+
+    def reconcile(self, resolved: pd.DataFrame) -> dict[str, int]:
+        """
+        Приводит уже записанные заказы к строкам ``resolved`` (см. ``resolve``),
+        меняя только отличающиеся строки: новые вставляются, у совпавших по
+        торговой точке и товару меняется количество, лишние удаляются. Заказы
+        без строк и лишние товары в заказе тоже удаляются. Возвращает число
+        вставленных, изменённых и удалённых строк.
+        """
+        existing = defaultdict(list)
+        rows = ProductInOrder.objects.filter(order__customer_order=self.customer_order).order_by("id")
+        for pk, tp_id, product_id, amount in rows.values_list("id", "order__trade_point_id", "product_id", "amount"):
+            existing[(tp_id, product_id)].append((pk, amount))
+        desired = defaultdict(list)
+        for tp_id, product_id, amount in zip(
+            resolved["trade_point_id"].tolist(), resolved["product_id"].tolist(), resolved[AMOUNT].tolist()
+        ):
+            desired[(tp_id, product_id)].append(amount)
+
+        inserts, updates, deletes = [], [], []
+        for key in existing.keys() | desired.keys():
+            # Строки с тем же количеством остаются как есть, остальные разбираются попарно
+            amounts = Counter(desired.get(key, []))
+            changed = []
+            for pk, amount in existing.get(key, []):
+                if amounts[amount] > 0:
+                    amounts[amount] -= 1
+                else:
+                    changed.append(pk)
+            new_amounts = list(amounts.elements())
+            updates += [ProductInOrder(pk=pk, amount=amount) for pk, amount in zip(changed, new_amounts)]
+            deletes += changed[len(new_amounts) :]
+            inserts += [(*key, amount) for amount in new_amounts[len(changed) :]]
+
+        self._orders = dict(self.customer_order.tp_orders.values_list("trade_point_id", "id"))
+        order_ids = self._resolve_orders(list({tp_id for tp_id, _, _ in inserts}))
+        bulk_insert(
+            ProductInOrder,
+            ["order_id", "product_id", "amount"],
+            ((order_ids[tp_id], product_id, amount) for tp_id, product_id, amount in inserts),
+            batch_size=self.batch_size,
+        )
+        ProductInOrder.objects.bulk_update(updates, ["amount"], batch_size=self.batch_size)
+        if deletes:
+            ProductInOrder.objects.filter(id__in=deletes).delete()
+
+        trade_point_ids = {tp_id for tp_id, _ in desired}
+        empty_orders = [order_id for tp_id, order_id in self._orders.items() if tp_id not in trade_point_ids]
+        if empty_orders:
+            Order.objects.filter(id__in=empty_orders).delete()
+            self._orders = {tp_id: order_id for tp_id, order_id in self._orders.items() if tp_id in trade_point_ids}
+
+        product_ids = {product_id for _, product_id in desired}
+        if self.attach_listed_products:
+            product_ids |= self.listed_products
+        attached = set(self.customer_order.products.values_list("id", flat=True))
+        if product_ids - attached:
+            self.customer_order.products.add(*(product_ids - attached))
+        if attached - product_ids:
+            self.customer_order.products.remove(*(attached - product_ids))
+        self._attached_products = product_ids
+        return {"inserted": len(inserts), "updated": len(updates), "deleted": len(deletes)}
+
+    def publish(self) -> None:
+        """Завершает запись файла; строки этого класса видны сразу, публиковать нечего."""
+
+    def _write(self, ordered: pd.DataFrame) -> None:
+        """Записывает строки с ненулевым количеством и найденными id торговой точки и товара."""
+        order_ids = self._resolve_orders(ordered["trade_point_id"].unique().tolist())
+        bulk_insert(
+            ProductInOrder,
+            ["order_id", "product_id", "amount"],
+            zip(
+                ordered["trade_point_id"].map(order_ids).tolist(),
+                ordered["product_id"].tolist(),
+                ordered[AMOUNT].tolist(),
+            ),
+            batch_size=self.batch_size,
+        )
+
+        self._attach_products(set(ordered["product_id"].tolist()))
+
+    def _attach_products(self, product_ids: set[int]) -> None:
+        """Привязывает товары к общему заказу, пропуская уже привязанные."""
+        if self._attached_products is None:
+            self._attached_products = set(self.customer_order.products.values_list("id", flat=True))
+        new_products = product_ids - self._attached_products
+        if new_products:
+            self.customer_order.products.add(*new_products)
+            self._attached_products |= new_products
+
+    def _resolve_trade_points(self, lines: pd.DataFrame) -> pd.DataFrame:
+        """Возвращает id торговых точек для уникальных ключей строк, создавая недостающие."""
+        column = self._trade_point_column
+        unique = _plain(lines[[TRADE_POINT, SAPCODE]].drop_duplicates(column))
+        keys = unique[column].tolist()
+        index = self._trade_point_index()
+
+        missing = unique[[key not in index for key in keys]]
+        if not missing.empty:
+            # Параллельный разбор того же клиента мог создать их после загрузки индекса
+            self._lock_customer()
+            self._add_trade_points(index, missing[column].tolist())
+            missing = missing[[key not in index for key in missing[column].tolist()]]
+        if not missing.empty:
+            TradePoint.objects.bulk_create(
+                [
+                    TradePoint(customer=self.customer, name=name, sapcode=sapcode)
+                    for name, sapcode in zip(missing[TRADE_POINT].tolist(), missing[SAPCODE].tolist())
+                ],
+                batch_size=self.batch_size,
+            )
+            self._add_trade_points(index, missing[column].tolist())
+            invalidate_index(self.customer.pk)
+        return pd.DataFrame([(key, index[key]) for key in keys], columns=[column, "trade_point_id"])
+
+    def _add_trade_points(self, index: dict, keys: list) -> None:
+        """Дополняет индекс торговыми точками с ключами ``keys`` из БД."""
+        queryset = TradePoint.objects.filter(customer=self.customer, **{f"{self.trade_point_key}__in": keys})
+        for key, pk in queryset.order_by("id").values_list(self.trade_point_key, "id"):
+            index.setdefault(key, pk)
+
+    def _trade_point_index(self) -> dict:
+        if self._trade_points is None:
+            index = load_index(TradePoint, self.customer.pk, (self.trade_point_key,))
+            self._trade_points = {key: pk for (key,), pk in index.items()}
+        return self._trade_points
+
+    def _resolve_products(self, lines: pd.DataFrame) -> pd.DataFrame:
+        """Возвращает id товаров клиента для уникальных ключей строк, создавая недостающие."""
+        columns = self._product_columns
+        unique = _plain(lines[[PRODUCT, VENDOR_CODE]].drop_duplicates(columns))
+        keys = list(unique[columns].itertuples(index=False, name=None))
+        index = self._product_index()
+
+        missing = unique[[key not in index for key in keys]]
+        if not missing.empty:
+            self._lock_customer()
+            self._add_products(index, missing[PRODUCT].tolist())
+            missing = missing[[key not in index for key in missing[columns].itertuples(index=False, name=None)]]
+        if not missing.empty:
+            CustomerProduct.objects.bulk_create(
+                [
+                    CustomerProduct(customer=self.customer, name=name, vendor_code=vendor_code)
+                    for name, vendor_code in zip(missing[PRODUCT].tolist(), missing[VENDOR_CODE].tolist())
+                ],
+                batch_size=self.batch_size,
+            )
+            self._add_products(index, missing[PRODUCT].tolist())
+            invalidate_index(self.customer.pk)
+        return pd.DataFrame([(*key, index[key]) for key in keys], columns=[*columns, "product_id"])
+
+    def _add_products(self, index: dict, names: list[str]) -> None:
+        """Дополняет индекс товарами клиента с названиями ``names`` из БД."""
+        queryset = CustomerProduct.objects.filter(customer=self.customer, name__in=names)
+        for row in queryset.order_by("id").values_list(*self.product_key, "id"):
+            index.setdefault(tuple(row[:-1]), row[-1])
+
+    def _lock_customer(self) -> None:
+        """
+        Блокирует создание торговых точек и товаров клиента до конца текущей
+        транзакции, чтобы параллельные разборы не создали дублей.
+        """
+        if not self._locked:
+            self.lock_wait += lock_customer(self.customer.pk)
+            self._locked = True
+
+    def _product_index(self) -> dict:
+        if self._products is None:
+            self._products = dict(load_index(CustomerProduct, self.customer.pk, self.product_key))
+        return self._products
+
+    def _resolve_orders(self, trade_point_ids: list[int]) -> dict[int, int]:
+        if self._orders is None:
+            self._orders = dict(self.customer_order.tp_orders.values_list("trade_point_id", "id"))
+        missing = [tp_id for tp_id in trade_point_ids if tp_id not in self._orders]
+        if missing:
+            bulk_insert(
+                Order,
+                ["customer_order_id", "trade_point_id"],
+                ((self.customer_order.pk, tp_id) for tp_id in missing),
+                batch_size=self.batch_size,
+            )
+            self._orders.update(
+                Order.objects.filter(customer_order=self.customer_order, trade_point_id__in=missing).values_list(
+                    "trade_point_id", "id"
+                )
+            )
+        return self._orders
+
+
+class StagingIngestor(OrderIngestor):
+    """
+    Пишет строки заказа в промежуточную таблицу ``StagedProductInOrder`` без
+    блокировок ``orders`` и ``products_in_orders``. ``publish`` переносит их в
+    рабочие таблицы тремя запросами ``INSERT ... SELECT`` в одной короткой
+    транзакции, так что чтение заказов не ждёт окончания разбора большого файла.
+    """
+
+    def _write(self, ordered: pd.DataFrame) -> None:
+        bulk_insert(
+            StagedProductInOrder,
+            ["customer_order_id", "trade_point_id", "product_id", "amount"],
+            zip(
+                [self.customer_order.pk] * len(ordered),
+                ordered["trade_point_id"].tolist(),
+                ordered["product_id"].tolist(),
+                ordered[AMOUNT].tolist(),
+            ),
+            batch_size=self.batch_size,
+        )
+
+    @transaction.atomic
+    def publish(self) -> None:
+        staged = StagedProductInOrder._meta.db_table
+        orders = Order._meta.db_table
+        products = CustomerOrder.products.through._meta.db_table
+        params = [self.customer_order.pk]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {orders} (customer_order_id, trade_point_id)
+                SELECT DISTINCT s.customer_order_id, s.trade_point_id FROM {staged} s
+                WHERE s.customer_order_id = %s AND NOT EXISTS (
+                    SELECT 1 FROM {orders} o
+                    WHERE o.customer_order_id = s.customer_order_id AND o.trade_point_id = s.trade_point_id
+                )
+                """,
+                params,
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {ProductInOrder._meta.db_table} (product_id, order_id, amount)
+                SELECT s.product_id, o.id, s.amount FROM {staged} s
+                JOIN {orders} o ON o.customer_order_id = s.customer_order_id AND o.trade_point_id = s.trade_point_id
+                WHERE s.customer_order_id = %s
+                ORDER BY s.id
+                """,
+                params,
+            )
+            cursor.execute(
+                f"""
+                INSERT INTO {products} (customerorder_id, customerproduct_id)
+                SELECT DISTINCT s.customer_order_id, s.product_id FROM {staged} s
+                WHERE s.customer_order_id = %s AND NOT EXISTS (
+                    SELECT 1 FROM {products} p
+                    WHERE p.customerorder_id = s.customer_order_id AND p.customerproduct_id = s.product_id
+                )
+                """,
+                params,
+            )
+        StagedProductInOrder.objects.filter(customer_order=self.customer_order).delete()
+
+
+class OrderPreview:
+    """
+    Сводка по строкам заказа без записи в БД: торговые точки с числом строк и
+    суммой количеств, новые и известные товары. Ключи и индексы поиска те же,
+    что у ``OrderIngestor``, поэтому "новыми" считаются ровно те объекты,
+    которые создал бы разбор. Строки можно передавать частями.
+    """
+
+    # Сколько названий новых товаров показывать в сводке
+    NEW_PRODUCTS_SHOWN = 50
+
+    def __init__(
+        self,
+        customer: Customer,
+        trade_point_key: str = "name",
+        product_key: tuple[str, ...] = ("name", "vendor_code"),
+    ):
+        self.customer = customer
+        self.trade_point_key = trade_point_key
+        self.product_key = product_key
+        self.lines_count = 0
+        self._trade_points: dict = {}
+        self._products: dict[tuple, str] = {}
+
+    def add(self, lines: pd.DataFrame) -> None:
+        tp_column = TRADE_POINT_FIELDS[self.trade_point_key]
+        product_columns = [PRODUCT_FIELDS[field] for field in self.product_key]
+        trade_points = _plain(lines[[TRADE_POINT, SAPCODE]].drop_duplicates(tp_column))
+        for key, name, sapcode in zip(trade_points[tp_column], trade_points[TRADE_POINT], trade_points[SAPCODE]):
+            self._trade_points.setdefault(key, {"name": name, "sapcode": sapcode, "lines_count": 0, "amount": 0})
+        products = _plain(lines[[PRODUCT, VENDOR_CODE]].drop_duplicates(product_columns))
+        for key, name in zip(products[product_columns].itertuples(index=False, name=None), products[PRODUCT]):
+            self._products.setdefault(key, name)
+
+        ordered = lines.loc[lines[AMOUNT] > 0]
+        self.lines_count += len(ordered)
+        totals = ordered.groupby(tp_column, observed=True)[AMOUNT].agg(["size", "sum"])
+        for key, size, amount in totals.itertuples(name=None):
+            self._trade_points[key]["lines_count"] += int(size)
+            self._trade_points[key]["amount"] += int(amount)
+
+    def summary(self) -> dict:
+        known_trade_points = {key for (key,) in load_index(TradePoint, self.customer.pk, (self.trade_point_key,))}
+        known_products = load_index(CustomerProduct, self.customer.pk, self.product_key)
+        new_products = [name for key, name in self._products.items() if key not in known_products]
+        return {
+            "lines_count": self.lines_count,
+            "trade_points": [
+                {**trade_point, "known": key in known_trade_points} for key, trade_point in self._trade_points.items()
+            ],
+            "products_count": len(self._products),
+            "new_products_count": len(new_products),
+            "new_products": new_products[: self.NEW_PRODUCTS_SHOWN],
+        }
@@ -0,0 +1,287 @@
+"""
+Описания форматов файлов заказов.
+
+Формат клиента задаётся декларативно через ``FileLayout``: как найти шапку, в каких
+колонках товар и артикул, лежат ли торговые точки в колонках ("широкий"
+формат) или в строках ("длинный"), где заканчиваются данные. ``compile_layout``
+один раз превращает описание в разборщик, который читает лист за один проход
+и без построчного обхода переводит его в таблицу строк заказа (см. ``backend.orders.ingestion``).
+Чтобы подключить нового клиента, достаточно добавить описание в ``LAYOUTS``.
+"""
+import re
+from collections.abc import Callable, Iterator
+from dataclasses import dataclass
+from functools import lru_cache
+from uuid import uuid4
+
+import pandas as pd
+
+from backend.orders.ingestion import (
+    AMOUNT,
+    PRODUCT,
+    SAPCODE,
+    TRADE_POINT,
+    VENDOR_CODE,
+    melt_lines,
+    normalize_lines,
+    to_quantities,
+)
+from backend.orders.readers import Reader, Sheet, iter_sheet, read_sheet
+
+Column = str | int
+
+
+@dataclass(frozen=True)
+class FileLayout:
+    """
+    Колонки задаются названием из первой строки шапки или номером (с нуля).
+    Если колонка товара задана названием, шапкой считается первая строка, где
+    оно встречается (не раньше ``skiprows``), поэтому лишние строки над шапкой
+    не ломают разбор. Иначе шапка начинается ровно после ``skiprows`` строк.
+
+    Широкий формат (``quantity_column`` не задан): все колонки с непустым
+    заголовком, кроме товара, артикула и ``ignore_columns``, - торговые точки.
+    Название и SAP код точки собираются из строк шапки по шаблонам
+    ``trade_point_name`` и ``trade_point_sapcode``.
+
+    Длинный формат: торговая точка берётся из ``trade_point_column`` или из
+    ячейки ``trade_point_cell`` (строка, колонка) над шапкой, количество - из
+    ``quantity_column``.
+    """
+
+    product_column: Column
+    vendor_code_column: Column | None = None
+    # Строк, которые точно идут до шапки, и строк в шапке
+    skiprows: int = 0
+    header_rows: int = 1
+    # Служебных строк между шапкой и данными
+    skip_data_rows: int = 0
+    # Широкий формат
+    ignore_columns: tuple[Column, ...] = ()
+    trade_point_name: str = "{0}"
+    trade_point_sapcode: str | None = None
+    # Длинный формат
+    trade_point_column: Column | None = None
+    quantity_column: Column | None = None
+    trade_point_cell: tuple[int, int] | None = None
+    trade_point_pattern: str | None = None
+    # Данные заканчиваются перед первой строкой с таким значением в колонке
+    stop_column: Column | None = None
+    stop_values: tuple = ()
+    # Обрезать пробелы в названиях и артикулах
+    strip: bool = True
+    # Артикулов в файле нет: новым товарам присваивается уникальный код
+    generate_vendor_codes: bool = False
+    # Файл - ZIP-архив, каждый .xlsx в нём - заказ одной торговой точки
+    archive: bool = False
+    # Поля, по которым ищутся существующие торговые точки и товары
+    trade_point_key: str = "name"
+    product_key: tuple[str, ...] = ("name", "vendor_code")
+    # Привязывать к общему заказу все товары файла, в том числе с нулевым количеством
+    attach_listed_products: bool = False
+
+    @property
+    def is_wide(self) -> bool:
+        return self.quantity_column is None
+
+
+LAYOUTS: dict[str, FileLayout] = {
+    "stroytorgovlya": FileLayout(
+        product_column="Второе наименование товара",
+        vendor_code_column="Артикул",
+        strip=False,
+    ),
+    "oseni": FileLayout(
+        product_column="Номенклатура",
+        vendor_code_column="Артикул",
+        trade_point_column="Магазин",
+        quantity_column="Количество",
+        stop_column="Номенклатура",
+        stop_values=("Итого:",),
+        attach_listed_products=True,
+    ),
+    "kruasan": FileLayout(
+        # Шапка из трёх строк: группа, название и SAP код торговой точки
+        header_rows=3,
+        product_column=0,
+        trade_point_name="{1} ({0})",
+        trade_point_sapcode="{2}",
+        generate_vendor_codes=True,
+        trade_point_key="sapcode",
+        product_key=("name",),
+    ),
+    "prodstarr": FileLayout(
+        skip_data_rows=1,
+        product_column="Контрагент",
+        ignore_columns=(1, 2, 3, 4),
+        strip=False,
+        product_key=("name",),
+    ),
+    "lavki-bakhusa": FileLayout(
+        archive=True,
+        product_column="Товар",
+        vendor_code_column="Артикул",
+        quantity_column="Кол-во",
+        trade_point_cell=(3, 3),
+        trade_point_pattern=r"\"(.*)\"",
+        stop_column="Артикул",
+        stop_values=(0, ""),
+        attach_listed_products=True,
+    ),
+}
+
+
+class CompiledLayout:
+    """
+    Разбор листа по описанию формата. Всё, что не зависит от содержимого
+    файла, вычисляется один раз при создании.
+    """
+
+    def __init__(self, layout: FileLayout):
+        self.layout = layout
+        pattern = re.compile(layout.trade_point_pattern) if layout.trade_point_pattern else None
+        self._stop_values = list(layout.stop_values)
+        self._extract_lines = _wide_extractor(layout) if layout.is_wide else _long_extractor(layout, pattern)
+
+    def find_header(self, rows: list[tuple]) -> int:
+        """Номер первой строки шапки среди первых строк листа."""
+        column = self.layout.product_column
+        if isinstance(column, int):
+            return self.layout.skiprows
+        for i, row in enumerate(rows[self.layout.skiprows :], start=self.layout.skiprows):
+            if column in row:
+                return i
+        raise ValueError(f"В первых {len(rows)} строках файла нет шапки с колонкой «{column}».")
+
+    def read(self, file, reader: Reader | None = None) -> Sheet:
+        """Читает лист за один проход: шапка ищется по первым строкам, остальное - данные."""
+        return read_sheet(file, self.find_header, self.layout.header_rows, reader=reader)
+
+    def iter_lines(
+        self,
+        file,
+        reader: Reader | None = None,
+        chunk_bytes: int | None = None,
+        chunk_rows: int | None = None,
+        start: int = 0,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Читает и разбирает лист частями (см. ``iter_sheet``), начиная с части
+        ``start``. Служебные строки после шапки и всё после стоп-значения
+        отбрасываются так же, как при разборе целиком, поэтому части в сумме
+        дают тот же результат. Части до ``start`` только читаются: в них
+        ищется стоп-значение, но строки заказа не строятся.
+        """
+        skip = self.layout.skip_data_rows
+        chunks = iter_sheet(
+            file, self.find_header, self.layout.header_rows, chunk_bytes, reader=reader, chunk_rows=chunk_rows
+        )
+        for number, sheet in enumerate(chunks):
+            data = sheet.data.iloc[skip:]
+            skip = max(0, skip - len(sheet.data))
+            if number < start:
+                if self._stop_row(data, _ColumnPositions(sheet.header)) is not None:
+                    return
+                continue
+            lines, stopped = self._extract(sheet, data)
+            yield lines
+            if stopped:
+                return
+
+    def __call__(self, sheet: Sheet) -> pd.DataFrame:
+        lines, _ = self._extract(sheet, sheet.data.iloc[self.layout.skip_data_rows :])
+        return lines
+
+    def _extract(self, sheet: Sheet, data: pd.DataFrame) -> tuple[pd.DataFrame, bool]:
+        """Возвращает строки заказа и признак того, что данные закончились на стоп-значении."""
+        positions = _ColumnPositions(sheet.header)
+        stop_row = self._stop_row(data, positions)
+        if stop_row is not None:
+            data = data.iloc[:stop_row]
+        return normalize_lines(self._extract_lines(sheet, data, positions)), stop_row is not None
+
+    def _stop_row(self, data: pd.DataFrame, positions: "_ColumnPositions") -> int | None:
+        """Номер первой строки со стоп-значением или ``None``."""
+        if self.layout.stop_column is None:
+            return None
+        stop = data[positions[self.layout.stop_column]].isin(self._stop_values).to_numpy()
+        return int(stop.argmax()) if stop.any() else None
+
+
+@lru_cache
+def compile_layout(layout: FileLayout) -> CompiledLayout:
+    return CompiledLayout(layout)
+
+
+class _ColumnPositions:
+    """Переводит колонку макета (название в шапке или номер) в номер колонки листа."""
+
+    def __init__(self, header: pd.DataFrame):
+        self._names = {} if header.empty else {value: i for i, value in reversed(list(enumerate(header.iloc[0])))}
+
+    def __getitem__(self, column: Column) -> int:
+        if isinstance(column, int):
+            return column
+        try:
+            return self._names[column]
+        except KeyError:
+            raise ValueError(f"В шапке файла нет колонки «{column}».") from None
+
+
+def _id_columns(layout: FileLayout, data: pd.DataFrame, positions: _ColumnPositions) -> pd.DataFrame:
+    ids = pd.DataFrame({PRODUCT: data[positions[layout.product_column]]})
+    if layout.vendor_code_column is not None:
+        ids[VENDOR_CODE] = data[positions[layout.vendor_code_column]]
+    if layout.strip:
+        ids = ids.apply(lambda column: column.astype(str).str.strip())
+    if layout.generate_vendor_codes:
+        ids[VENDOR_CODE] = ids[PRODUCT].map({name: uuid4().hex for name in ids[PRODUCT].unique()})
+    return ids
+
+
+def _is_blank(value) -> bool:
+    return value is None or value == 0 or value == "" or (isinstance(value, float) and pd.isna(value))
+
+
+def _wide_extractor(layout: FileLayout) -> Callable:
+    def extract_lines(sheet, data, positions) -> pd.DataFrame:
+        header = sheet.header
+        ids = _id_columns(layout, data, positions)
+        excluded = {positions[layout.product_column]} | {positions[column] for column in layout.ignore_columns}
+        if layout.vendor_code_column is not None:
+            excluded.add(positions[layout.vendor_code_column])
+
+        trade_points = {}
+        for position in range(header.shape[1]):
+            values = header.iloc[:, position].tolist()
+            # Колонки без заголовка не считаются торговыми точками
+            if position in excluded or all(_is_blank(value) for value in values):
+                continue
+            trade_point = {TRADE_POINT: layout.trade_point_name.format(*values)}
+            if layout.trade_point_sapcode is not None:
+                trade_point[SAPCODE] = layout.trade_point_sapcode.format(*values)
+            trade_points[position] = trade_point
+
+        # Количества торговых точек - один сплошной блок int32
+        frame = pd.concat([ids, to_quantities(data[list(trade_points)])], axis=1)
+        return melt_lines(frame, {column: column for column in ids.columns}, trade_points)
+
+    return extract_lines
+
+
+def _long_extractor(layout: FileLayout, pattern: re.Pattern | None) -> Callable:
+    def extract_lines(sheet, data, positions) -> pd.DataFrame:
+        lines = _id_columns(layout, data, positions)
+        lines[AMOUNT] = data[positions[layout.quantity_column]]
+        if layout.trade_point_column is not None:
+            lines[TRADE_POINT] = data[positions[layout.trade_point_column]]
+        elif layout.trade_point_cell is not None:
+            row, column = layout.trade_point_cell
+            value = str(sheet.head[row][column])
+            match = pattern.search(value) if pattern else None
+            lines[TRADE_POINT] = match.group(1) if match else value
+        else:
+            raise ValueError("В формате не задана ни колонка, ни ячейка торговой точки.")
+        return lines
+
+    return extract_lines
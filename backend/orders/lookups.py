@@ -0,0 +1,81 @@
+"""
+Индекс поиска торговых точек и товаров клиента.
+
+Для каждого клиента в кэше (Redis в production) хранится словарь
+"значения ключевых полей -> id" для торговых точек и товаров. Парсер загружает
+его один раз на загрузку файла, и сопоставление строк файла с объектами
+сводится к поиску в словаре. Сохранение и удаление моделей сбрасывает индекс
+клиента (см. ``backend.orders.signals``).
+
+Создание торговых точек и товаров одного клиента разными разборами
+сериализуется блокировкой клиента (``lock_customer``), разборы разных
+клиентов друг друга не ждут.
+
+Индексы клиента хранятся под общей версией: сброс удаляет только версию, а
+старые записи перестают читаться и истекают сами.
+"""
+import time
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import connection, models, transaction
+
+# Индекс живёт сутки, даже если сброс по какой-то причине не дошёл
+INDEX_TIMEOUT = 60 * 60 * 24
+
+# Первый ключ advisory-блокировок клиента в PostgreSQL, второй - id клиента
+CUSTOMER_LOCK_NAMESPACE = 1
+
+
+def _version_key(customer_id: int) -> str:
+    return f"orders:index:{customer_id}:version"
+
+
+def _version(customer_id: int) -> str:
+    key = _version_key(customer_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        # Версию могли создать параллельно - тогда используется уже записанная
+        if not cache.add(key, version, INDEX_TIMEOUT):
+            version = cache.get(key) or version
+    return version
+
+
+def load_index(model: type[models.Model], customer_id: int, fields: tuple[str, ...]) -> dict[tuple, int]:
+    """
+    Возвращает индекс объектов клиента по полям ``fields``. При совпадении
+    ключей побеждает объект с меньшим id. Версия читается до запроса в БД,
+    чтобы индекс, собранный до сброса, не попал под новую версию.
+    """
+    version = _version(customer_id)
+    key = f"orders:index:{customer_id}:{version}:{model._meta.model_name}:{','.join(fields)}"
+    index = cache.get(key)
+    if index is None:
+        index = {}
+        for row in model._default_manager.filter(customer_id=customer_id).order_by("id").values_list(*fields, "id"):
+            index.setdefault(tuple(row[:-1]), row[-1])
+        cache.set(key, index, INDEX_TIMEOUT)
+    return index
+
+
+def invalidate_index(customer_id: int) -> None:
+    """Сбрасывает индексы клиента после фиксации текущей транзакции."""
+    transaction.on_commit(lambda: cache.delete(_version_key(customer_id)))
+
+
+def lock_customer(customer_id: int) -> float:
+    """
+    Берёт advisory-блокировку клиента в PostgreSQL до конца текущей транзакции
+    (к этому моменту созданные объекты уже видны другим разборам) и возвращает
+    время ожидания в секундах. На других базах ничего не делает.
+    """
+    if connection.vendor != "postgresql":
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", [CUSTOMER_LOCK_NAMESPACE, customer_id])
+        if cursor.fetchone()[0]:
+            return 0.0
+        started = time.monotonic()
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [CUSTOMER_LOCK_NAMESPACE, customer_id])
+    return time.monotonic() - started
@@ -0,0 +1,75 @@
+import time
+from datetime import date
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from backend.orders.models import CustomerOrder
+from backend.orders.tasks import reparse_customer_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Повторно разбирает сохранённые файлы общих заказов и перестраивает заказы на торговые точки. "
+        "Разбор идёт в задачах Celery в нескольких параллельных очередях, заказы одного клиента - по порядку."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--customer", action="append", default=[], help="Код клиента, можно несколько")
+        parser.add_argument(
+            "--status",
+            action="append",
+            default=[],
+            choices=CustomerOrder.Status.values,
+            help="Статус заказа, можно несколько",
+        )
+        parser.add_argument("--since", type=date.fromisoformat, help="Заказы, созданные с этой даты (ГГГГ-ММ-ДД)")
+        parser.add_argument("--until", type=date.fromisoformat, help="Заказы, созданные до этой даты (не включая)")
+        parser.add_argument("--id", action="append", type=int, default=[], help="Id общего заказа, можно несколько")
+        parser.add_argument(
+            "--lanes",
+            type=int,
+            default=settings.ORDER_REPARSE_LANES,
+            help="Сколько файлов разбирать одновременно",
+        )
+        parser.add_argument("--wait", action="store_true", help="Дождаться окончания, печатая ход разбора")
+        parser.add_argument("--interval", type=float, default=5.0, help="Как часто печатать ход разбора, секунд")
+
+    def handle(self, *args, **options):
+        if options["lanes"] < 1:
+            raise CommandError("--lanes должно быть не меньше 1.")
+        customer_orders = CustomerOrder.objects.all()
+        if options["customer"]:
+            customer_orders = customer_orders.filter(customer__code__in=options["customer"])
+        if options["status"]:
+            customer_orders = customer_orders.filter(status__in=options["status"])
+        if options["since"]:
+            customer_orders = customer_orders.filter(created__date__gte=options["since"])
+        if options["until"]:
+            customer_orders = customer_orders.filter(created__date__lt=options["until"])
+        if options["id"]:
+            customer_orders = customer_orders.filter(id__in=options["id"])
+
+        ids, skipped = reparse_customer_orders(customer_orders, lanes=options["lanes"])
+        self.stdout.write(f"В очереди на повторный разбор {len(ids)} заказов, очередей: {options['lanes']}.")
+        if skipped:
+            self.stdout.write(f"Пропущено заказов, которые ещё ждут разбора или разбираются: {skipped}.")
+        if not options["wait"]:
+            return
+
+        while True:
+            statuses = dict(
+                CustomerOrder.objects.filter(id__in=ids).values_list("status").annotate(count=Count("id")).order_by()
+            )
+            # Удалённые за время разбора заказы не считаются
+            total = sum(statuses.values())
+            done = statuses.get(CustomerOrder.Status.DONE, 0)
+            failed = statuses.get(CustomerOrder.Status.FAILED, 0)
+            self.stdout.write(f"Разобрано {done + failed} из {total}, с ошибкой {failed}.")
+            if done + failed == total:
+                break
+            time.sleep(options["interval"])
+        if failed:
+            failed_ids = CustomerOrder.objects.filter(id__in=ids, status=CustomerOrder.Status.FAILED)
+            self.stdout.write(f"Заказы с ошибкой: {', '.join(map(str, failed_ids.values_list('id', flat=True)))}")
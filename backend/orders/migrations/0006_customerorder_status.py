@@ -0,0 +1,55 @@
+# Generated by Django 4.2.5 on 2026-10-17 23:46
+
+from django.db import migrations, models
+
+
+def mark_existing_orders_done(apps, schema_editor):
+    # Заказы, загруженные до появления статуса, уже разобраны синхронно
+    CustomerOrder = apps.get_model("orders", "CustomerOrder")
+    CustomerOrder.objects.update(status="done")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0005_rename_product_customerproduct_base_product"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customerorder",
+            name="error",
+            field=models.TextField(blank=True, verbose_name="Ошибка обработки"),
+        ),
+        migrations.AddField(
+            model_name="customerorder",
+            name="lines_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="Количество строк заказа"),
+        ),
+        migrations.AddField(
+            model_name="customerorder",
+            name="orders_count",
+            field=models.PositiveIntegerField(default=0, verbose_name="Количество заказов на торговые точки"),
+        ),
+        migrations.AddField(
+            model_name="customerorder",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("queued", "В очереди"),
+                    ("running", "Обрабатывается"),
+                    ("done", "Обработан"),
+                    ("failed", "Ошибка"),
+                ],
+                default="queued",
+                max_length=10,
+                verbose_name="Статус обработки",
+            ),
+        ),
+        migrations.AddField(
+            model_name="customerorder",
+            name="task_id",
+            field=models.CharField(blank=True, max_length=255, verbose_name="ID задачи обработки"),
+        ),
+        migrations.RunPython(mark_existing_orders_done, migrations.RunPython.noop),
+    ]
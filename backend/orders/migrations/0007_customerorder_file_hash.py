@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-17 23:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0006_customerorder_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customerorder",
+            name="file_hash",
+            field=models.CharField(blank=True, max_length=64, verbose_name="SHA-256 файла"),
+        ),
+        migrations.AddIndex(
+            model_name="customerorder",
+            index=models.Index(fields=["customer", "file_hash"], name="customer_or_custome_4b414e_idx"),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-17 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0007_customerorder_file_hash"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customerorder",
+            name="checkpoint",
+            field=models.PositiveIntegerField(default=0, verbose_name="Записано частей файла"),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 4.2.5 on 2026-10-18 00:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_unlogged(apps, schema_editor):
+    # Промежуточные строки не нужно восстанавливать после сбоя, поэтому WAL для них не пишется
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE staged_products_in_orders SET UNLOGGED")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0008_customerorder_checkpoint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StagedProductInOrder",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("amount", models.PositiveIntegerField()),
+                (
+                    "customer_order",
+                    models.ForeignKey(
+                        db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to="orders.customerorder"
+                    ),
+                ),
+                (
+                    "product",
+                    models.ForeignKey(
+                        db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to="orders.customerproduct"
+                    ),
+                ),
+                (
+                    "trade_point",
+                    models.ForeignKey(
+                        db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to="orders.tradepoint"
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Неопубликованный товар в заказе",
+                "verbose_name_plural": "Неопубликованные товары в заказах",
+                "db_table": "staged_products_in_orders",
+            },
+        ),
+        migrations.RunPython(set_unlogged, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 00:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0009_stagedproductinorder"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customerorder",
+            name="lock_wait",
+            field=models.FloatField(default=0, verbose_name="Ожидание блокировки клиента, с"),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 4.2.5 on 2026-10-18 00:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0010_customerorder_lock_wait"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customerorder",
+            name="idempotency_key",
+            field=models.CharField(blank=True, max_length=255, verbose_name="Ключ идемпотентности"),
+        ),
+        migrations.AddConstraint(
+            model_name="customerorder",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("idempotency_key", ""), _negated=True),
+                fields=("customer", "idempotency_key"),
+                name="customer_order_idempotency_key",
+            ),
+        ),
+    ]
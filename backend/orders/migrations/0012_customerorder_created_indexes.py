@@ -0,0 +1,21 @@
+# Generated by Django 4.2.5 on 2026-10-18 00:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("orders", "0011_customerorder_idempotency_key"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customerorder",
+            index=models.Index(fields=["created", "id"], name="customer_or_created_9a0b0a_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="customerorder",
+            index=models.Index(fields=["customer", "created"], name="customer_or_custome_ac7958_idx"),
+        ),
+    ]
@@ -112,6 +112,12 @@ class CustomerOrder(models.Model):
     Общий заказ клиента на все торговые точки
     """
 
+    class Status(models.TextChoices):
+        QUEUED = "queued", "В очереди"
+        RUNNING = "running", "Обрабатывается"
+        DONE = "done", "Обработан"
+        FAILED = "failed", "Ошибка"
+
     customer = models.ForeignKey(
         Customer, on_delete=models.CASCADE, verbose_name="Клиент", related_name="orders"
     )
@@ -119,6 +125,36 @@ class CustomerOrder(models.Model):
     products = models.ManyToManyField(
         CustomerProduct, related_name="customer_orders", verbose_name="Товары в заказе"
     )
+    status = models.CharField(
+        max_length=10,
+        choices=Status.choices,
+        default=Status.QUEUED,
+        verbose_name="Статус обработки",
+    )
+    task_id = models.CharField(
+        max_length=255, blank=True, verbose_name="ID задачи обработки"
+    )
+    error = models.TextField(blank=True, verbose_name="Ошибка обработки")
+    lines_count = models.PositiveIntegerField(
+        default=0, verbose_name="Количество строк заказа"
+    )
+    orders_count = models.PositiveIntegerField(
+        default=0, verbose_name="Количество заказов на торговые точки"
+    )
+    # Разбор идёт частями; повторный запуск продолжает с первой незаписанной
+    checkpoint = models.PositiveIntegerField(
+        default=0, verbose_name="Записано частей файла"
+    )
+    lock_wait = models.FloatField(
+        default=0, verbose_name="Ожидание блокировки клиента, с"
+    )
+    # Заголовок Idempotency-Key запроса, создавшего заказ
+    idempotency_key = models.CharField(
+        max_length=255, blank=True, verbose_name="Ключ идемпотентности"
+    )
+    file_hash = models.CharField(
+        max_length=64, blank=True, verbose_name="SHA-256 файла"
+    )
     created = models.DateTimeField(auto_now_add=True, verbose_name="Создано")
     modified = models.DateTimeField(auto_now=True, verbose_name="Изменено")
 
@@ -127,6 +163,19 @@ class CustomerOrder(models.Model):
         verbose_name = "Общий заказ"
         verbose_name_plural = "Общие заказы"
         db_table = "customer_orders"
+        indexes = [
+            models.Index(fields=["customer", "file_hash"]),
+            # Курсорная пагинация по дате создания, в том числе в заказах одного клиента
+            models.Index(fields=["created", "id"]),
+            models.Index(fields=["customer", "created"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["customer", "idempotency_key"],
+                condition=~models.Q(idempotency_key=""),
+                name="customer_order_idempotency_key",
+            )
+        ]
 
     def __str__(self):
         created = self.created.astimezone().strftime("%d.%m.%Y %H:%M")
@@ -177,3 +226,22 @@ class ProductInOrder(models.Model):
         verbose_name = "Товар в заказе"
         verbose_name_plural = "Товары в заказах"
         db_table = "products_in_orders"
+
+
+class StagedProductInOrder(models.Model):
+    """
+    Строка заказа, записанная при разборе файла, но ещё не опубликованная в
+    ``orders`` и ``products_in_orders`` (см. ``backend.orders.ingestion.StagingIngestor``).
+    В PostgreSQL таблица нежурналируемая: она не пишет WAL, а после сбоя
+    достаточно разобрать файл заново.
+    """
+
+    customer_order = models.ForeignKey(CustomerOrder, on_delete=models.CASCADE, db_constraint=False)
+    trade_point = models.ForeignKey(TradePoint, on_delete=models.CASCADE, db_constraint=False)
+    product = models.ForeignKey(CustomerProduct, on_delete=models.CASCADE, db_constraint=False)
+    amount = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = "Неопубликованный товар в заказе"
+        verbose_name_plural = "Неопубликованные товары в заказах"
+        db_table = "staged_products_in_orders"
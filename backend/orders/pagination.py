@@ -0,0 +1,21 @@
+"""
+Курсорная пагинация API заказов.
+
+Страница выбирается условием по индексированной колонке (``created`` или
+``id``), а не смещением, поэтому время ответа не растёт с числом записей, а
+новые записи не сдвигают уже полученные страницы.
+"""
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class IdCursorPagination(CursorPagination):
+    ordering: str | tuple[str, ...] = "id"
+    page_size = settings.ORDER_API_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.ORDER_API_MAX_PAGE_SIZE
+
+
+class CreatedCursorPagination(IdCursorPagination):
+    # Новые заказы первыми, при одинаковом времени создания - по id
+    ordering = ("-created", "-id")
@@ -0,0 +1,185 @@
+"""
+Чтение файлов заказов.
+
+Строки листа читаются потоком и сразу превращаются в значения: пустые ячейки
+заполняются при чтении, а не копией DataFrame. Движок чтения подключаемый:
+``openpyxl`` в режиме ``read_only`` доступен всегда, а более быстрый
+``calamine`` (Rust, пакет ``python-calamine``) используется, если установлен.
+"""
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable, Iterator
+from itertools import chain, islice
+from typing import NamedTuple
+
+import pandas as pd
+from openpyxl import load_workbook
+
+try:
+    import python_calamine
+except ImportError:  # pragma: no cover
+    python_calamine = None  # type: ignore[assignment]
+
+OPENPYXL = "openpyxl"
+CALAMINE = "calamine"
+
+# Сколько строк с начала листа просматривается в поисках шапки
+PROBE_ROWS = 50
+
+# Примерная память на ячейку листа при разборе: значение в строке, ссылка в
+# DataFrame и строка заказа после разворота широкой таблицы
+CELL_BYTES = 100
+
+
+class Reader(ABC):
+    engine: str
+
+    @abstractmethod
+    def iter_rows(self, file, skiprows: int = 0) -> Iterator[tuple]:
+        """Лениво отдаёт значения строк первого листа, пропуская ``skiprows`` строк."""
+        raise NotImplementedError("Subclasses must implement iter_rows method.")
+
+
+class OpenpyxlReader(Reader):
+    engine = OPENPYXL
+
+    def iter_rows(self, file, skiprows: int = 0) -> Iterator[tuple]:
+        workbook = load_workbook(file, read_only=True, data_only=True)
+        try:
+            sheet = workbook.active
+            # Размеры листа в заголовке файла часто записаны неверно
+            sheet.reset_dimensions()
+            for row in sheet.iter_rows(min_row=skiprows + 1, values_only=True):
+                yield tuple(_convert(value) for value in row)
+        finally:
+            workbook.close()
+
+
+class CalamineReader(Reader):
+    engine = CALAMINE
+
+    def iter_rows(self, file, skiprows: int = 0) -> Iterator[tuple]:
+        workbook = python_calamine.CalamineWorkbook.from_filelike(file)
+        try:
+            sheet = workbook.get_sheet_by_index(0)
+            # iter_rows отдаёт строки по одной, считая строки от первой, а колонки - от первой
+            # непустой; пустые колонки слева добавляются, чтобы номера колонок шли от A, как в openpyxl
+            padding = (None,) * (sheet.start[1] if sheet.start else 0)
+            for row in islice(sheet.iter_rows(), skiprows, None):
+                yield padding + tuple(None if value == "" else _convert(value) for value in row)
+        finally:
+            workbook.close()
+
+
+READERS: dict[str, type[Reader]] = {
+    OPENPYXL: OpenpyxlReader,
+    CALAMINE: CalamineReader,
+}
+
+
+def get_reader(engine: str = OPENPYXL) -> Reader:
+    """Возвращает читатель для движка; без ``python-calamine`` откатывается на openpyxl."""
+    if engine not in READERS:
+        raise ValueError(f"Unknown reader engine: {engine}")
+    if engine == CALAMINE and python_calamine is None:
+        engine = OPENPYXL
+    return READERS[engine]()
+
+
+def iter_rows(file, skiprows: int = 0, reader: Reader | None = None) -> Iterator[tuple]:
+    """Лениво отдаёт значения строк первого листа, пропуская ``skiprows`` строк."""
+    reader = reader or get_reader()
+    return reader.iter_rows(file, skiprows)
+
+
+def iter_data_rows(rows: Iterator[tuple]) -> Iterator[tuple]:
+    """Отбрасывает пустые строки в конце листа, сохраняя пустые строки между данными."""
+    blank = []
+    for row in rows:
+        if all(value is None or value == "" for value in row):
+            blank.append(row)
+            continue
+        yield from blank
+        blank.clear()
+        yield row
+
+
+class Sheet(NamedTuple):
+    """Лист, разделённый на шапку и данные; колонки пронумерованы с нуля."""
+
+    # Строки от начала листа до конца шапки включительно
+    head: list[tuple]
+    header: pd.DataFrame
+    data: pd.DataFrame
+
+
+def read_sheet(
+    file,
+    find_header: Callable[[list[tuple]], int],
+    header_rows: int = 1,
+    probe_rows: int = PROBE_ROWS,
+    fill_value=0,
+    reader: Reader | None = None,
+) -> Sheet:
+    """
+    Читает лист за один проход. Первые ``probe_rows`` строк буферизуются, и
+    ``find_header`` находит среди них номер первой строки шапки. Остальные
+    строки того же потока сразу идут в данные, без повторного чтения файла.
+    """
+    (sheet,) = iter_sheet(file, find_header, header_rows, probe_rows=probe_rows, fill_value=fill_value, reader=reader)
+    return sheet
+
+
+def iter_sheet(
+    file,
+    find_header: Callable[[list[tuple]], int],
+    header_rows: int = 1,
+    chunk_bytes: int | None = None,
+    probe_rows: int = PROBE_ROWS,
+    fill_value=0,
+    reader: Reader | None = None,
+    chunk_rows: int | None = None,
+) -> Iterator[Sheet]:
+    """
+    Как ``read_sheet``, но отдаёт данные частями с общей шапкой. В части не
+    больше ``chunk_rows`` строк и не больше, чем укладывается в ``chunk_bytes``
+    при разборе (по ширине шапки); без ограничений весь лист - одна часть.
+    """
+    rows = iter_data_rows(iter_rows(file, 0, reader))
+    head = list(islice(rows, probe_rows))
+    start = find_header(head)
+    end = start + header_rows
+    head += islice(rows, max(0, end - len(head)))
+    header, header_width = _fill_rows(head[start:end], fill_value)
+
+    rows = chain(head[end:], rows)
+    if chunk_bytes:
+        budget_rows = max(1, chunk_bytes // (CELL_BYTES * max(header_width, 1)))
+        chunk_rows = min(chunk_rows or budget_rows, budget_rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        data, width = _fill_rows(chunk, fill_value, header_width)
+        yield Sheet(
+            head=head[:end],
+            header=pd.DataFrame([row + [fill_value] * (width - len(row)) for row in header], columns=range(width)),
+            data=pd.DataFrame(data, columns=range(width)),
+        )
+        if chunk_rows is None or len(chunk) < chunk_rows:
+            return
+
+
+def _fill_rows(rows: Iterable[tuple], fill_value, width: int = 0) -> tuple[list[list], int]:
+    """Заменяет пустые ячейки на ``fill_value`` и выравнивает строки по ширине."""
+    data: list[list] = []
+    for row in rows:
+        data.append([fill_value if value is None else value for value in row])
+        width = max(width, len(row))
+    for line in data:
+        line.extend([fill_value] * (width - len(line)))
+    return data, width
+
+
+def _convert(value):
+    # Excel хранит все числа как float, целые значения приводим к int, как pandas
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
@@ -16,12 +16,19 @@ class CustomerSerializer(serializers.ModelSerializer):
     last_order = serializers.SerializerMethodField(read_only=True)
 
     def get_tp_count(self, obj):
+        # В списке клиентов количество посчитано в запросе (см. CustomerViewSet.queryset)
+        if hasattr(obj, "trade_points_count"):
+            return obj.trade_points_count
         return obj.trade_points.count()
 
     def get_last_order(self, obj):
-        last_order = obj.orders.order_by("-created").first()
-
-        return CustomerOrderSerializer(last_order).data
+        if hasattr(obj, "last_orders"):
+            last_order = obj.last_orders[0] if obj.last_orders else None
+        else:
+            last_order = obj.orders.order_by("-created", "-id").first()
+        if last_order is None:
+            return None
+        return CustomerOrderSummarySerializer(last_order).data
 
     class Meta:
         model = Customer
@@ -113,7 +120,8 @@ class OrderSerializer(serializers.ModelSerializer):
     products_list = serializers.SerializerMethodField(read_only=True)
 
     def get_products_list(self, obj):
-        products = ProductInOrder.objects.filter(order=obj)
+        # Строки заказа с товарами подгружаются заранее (см. OrderViewSet.queryset)
+        products = obj.productinorder_set.all()
         return ProductInOrderSerializer(products, many=True).data
 
     class Meta:
@@ -144,4 +152,93 @@ class CustomerOrderSerializer(serializers.ModelSerializer):
             "order_in_packs",
             "products",
             "created",
+            "status",
+            "task_id",
+        ]
+        read_only_fields = ["status", "task_id"]
+
+
+class CustomerOrderListSerializer(CustomerOrderSerializer):
+    """
+    Общий заказ в списке: вместо товаров - их число и число товаров без
+    сопоставления с внутренней матрицей. Сами товары отдаёт
+    ``/customer-orders/{id}/products/``.
+    """
+
+    products_count = serializers.IntegerField(read_only=True)
+    unmapped_products_count = serializers.IntegerField(read_only=True)
+
+    class Meta(CustomerOrderSerializer.Meta):
+        fields = [field for field in CustomerOrderSerializer.Meta.fields if field != "products"] + [
+            "products_count",
+            "unmapped_products_count",
+        ]
+
+
+class CustomerOrderStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomerOrder
+        fields = [
+            "id",
+            "task_id",
+            "status",
+            "lines_count",
+            "orders_count",
+            "checkpoint",
+            "lock_wait",
+            "error",
         ]
+
+
+class CustomerOrderSummarySerializer(serializers.ModelSerializer):
+    created = serializers.DateTimeField(format="%d.%m.%Y", read_only=True)
+
+    class Meta:
+        model = CustomerOrder
+        fields = [
+            "id",
+            "file",
+            "created",
+            "status",
+            "lines_count",
+            "orders_count",
+        ]
+
+
+class PreviewTradePointSerializer(serializers.Serializer):
+    name = serializers.CharField()
+    sapcode = serializers.CharField()
+    known = serializers.BooleanField()
+    lines_count = serializers.IntegerField()
+    amount = serializers.IntegerField()
+
+
+class CustomerOrderPreviewSerializer(serializers.Serializer):
+    lines_count = serializers.IntegerField()
+    trade_points = PreviewTradePointSerializer(many=True)
+    products_count = serializers.IntegerField()
+    new_products_count = serializers.IntegerField()
+    new_products = serializers.ListField(child=serializers.CharField())
+
+
+class MatrixTradePointSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    sapcode = serializers.CharField()
+
+
+class MatrixProductSerializer(serializers.Serializer):
+    id = serializers.IntegerField()
+    product_name = serializers.CharField()
+    vendor_code = serializers.CharField()
+    base_product_name = serializers.CharField()
+    base_vendor_code = serializers.CharField()
+    amount_in_pack = serializers.IntegerField()
+
+
+class CustomerOrderMatrixSerializer(serializers.Serializer):
+    trade_points = MatrixTradePointSerializer(many=True)
+    products = MatrixProductSerializer(many=True)
+    dense = serializers.BooleanField()
+    # Тройки [номер точки, номер товара, количество] или, если dense, строки количеств по точкам
+    amounts = serializers.ListField(child=serializers.ListField(child=serializers.IntegerField()))
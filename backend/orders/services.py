@@ -1,393 +1,129 @@
+import logging
 import os
-import re
+import tempfile
 import zipfile
 from abc import ABC, abstractmethod
-from uuid import uuid4
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
+import billiard
 import pandas as pd
+from celery.exceptions import SoftTimeLimitExceeded
 from django.conf import settings
-from django.db.models import QuerySet
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.db.models import QuerySet, Sum
+
+from backend.orders.ingestion import (
+    BATCH_SIZE,
+    RESOLVED_COLUMNS,
+    OrderIngestor,
+    OrderPreview,
+    StagingIngestor,
+)
+from backend.orders.layouts import LAYOUTS, FileLayout, compile_layout
 
 # from loguru import logger
-from backend.orders.models import (
-    Customer,
-    CustomerOrder,
-    CustomerProduct,
-    Order,
-    ProductInOrder,
-    TradePoint,
-)
+from backend.orders.models import Customer, CustomerOrder, Order, ProductInOrder, StagedProductInOrder
+from backend.orders.readers import Reader, get_reader
+
+logger = logging.getLogger(__name__)
+
+
+def map_in_processes(func: Callable, jobs: list[tuple], processes: int) -> Iterator:
+    """
+    Выполняет ``func`` для каждого набора аргументов в пуле из ``processes``
+    процессов (0 - по числу ядер) и отдаёт результаты в исходном порядке по
+    мере готовности. Функция не должна обращаться к БД. Процессы пула
+    создаются через billiard, а не multiprocessing: процесс воркера Celery с
+    пулом prefork демонический, и запускать дочерние процессы из него
+    позволяет только billiard.
+    """
+    if processes == 1 or len(jobs) < 2:
+        for job in jobs:
+            yield func(*job)
+        return
+    executor = ProcessPoolExecutor(
+        max_workers=min(processes or os.cpu_count() or 1, len(jobs)), mp_context=billiard.get_context()
+    )
+    try:
+        yield from executor.map(func, *zip(*jobs))
+    finally:
+        # Если результаты перестали забирать (ошибка записи), оставшиеся задания не нужны
+        executor.shutdown(cancel_futures=True)
 
 
 class Parser(ABC):
-    def __init__(self, customer_order: CustomerOrder):
+    # Поле, по которому ищется существующая торговая точка клиента
+    _TRADE_POINT_KEY = "name"
+    # Поля, по которым ищется существующий товар клиента
+    _PRODUCT_KEY: tuple[str, ...] = ("name", "vendor_code")
+    # Привязывать к общему заказу все товары файла, а не только заказанные
+    _ATTACH_LISTED_PRODUCTS = False
+
+    def __init__(self, customer_order: CustomerOrder, reader: Reader | None = None, processes: int | None = None):
         self.customer_order: CustomerOrder = customer_order
         self.customer: Customer = customer_order.customer
         self.file = customer_order.file
         self.trade_points: QuerySet = self.customer.trade_points.all()
-        self.file_path = os.path.join(settings.MEDIA_ROOT, self.file.name)
-
-    @abstractmethod
-    def _read(self) -> pd.DataFrame:
-        raise NotImplementedError("Subclasses must implement _read method.")
-
-    @abstractmethod
-    def _parse_products(self, df: pd.DataFrame) -> None:
-        raise NotImplementedError("Subclasses must implement parse_products method.")
-
-    @abstractmethod
-    def _parse_trade_points(self, df: pd.DataFrame) -> list[TradePoint]:
-        raise NotImplementedError("Subclasses must implement method.")
-
-    @abstractmethod
-    def _create_orders(self, df: pd.DataFrame, tp_list: list[TradePoint]) -> None:
-        raise NotImplementedError("Subclasses must implement method.")
+        # Путь нужен архивам: файлы внутри открываются в дочерних процессах.
+        # Несохранённый файл (предпросмотр) лежит во временном файле
+        if self.file._committed:
+            self.file_path = os.path.join(settings.MEDIA_ROOT, self.file.name)
+        else:
+            self.file_path = self.file.file.name
+        self.reader: Reader = reader or ParserFactory().create_reader(self.customer.code)
+        # Сколько процессов разбирают файлы архива (см. map_in_processes)
+        self.processes: int = settings.ORDER_PARSE_PROCESSES if processes is None else processes
+        ingestor_class = StagingIngestor if settings.ORDER_INGEST_STAGING else OrderIngestor
+        self.ingestor = ingestor_class(
+            customer_order,
+            trade_point_key=self._TRADE_POINT_KEY,
+            product_key=self._PRODUCT_KEY,
+            attach_listed_products=self._ATTACH_LISTED_PRODUCTS,
+        )
 
     @abstractmethod
-    def parse(self):
-        raise NotImplementedError("Subclasses must implement parse method.")
-
-
-class StroiTorgovlyaParser(Parser):
-    _PRODUCT_COLUMN_NAME = "Второе наименование товара"
-    _CODE_COLUMN_NAME = "Артикул"
-    _SKIPROWS = 1
-
-    def _read(self) -> pd.DataFrame:
-        try:
-            df = pd.read_excel(
-                self.file,
-                skiprows=self._SKIPROWS,
-                engine="openpyxl",
-            )
-            # df = df.drop(df.columns[0], axis=1)  # удаляем первую колонку с Артикулом
-        except Exception as e:
-            print("Не получилось обработать файл", e)
-            raise
-
-        # Заполняем пустые ячейки нулями
-        df = df.fillna(0)
-
-        if df.empty:
-            print("Из файла не загрузилось ни одной строки!")
-
-        return df
-
-    def _parse_trade_points(self, df: pd.DataFrame) -> list[TradePoint]:
-        tp_list = []
-        tp_names = df.columns.tolist()
-        tp_names.remove(self._PRODUCT_COLUMN_NAME)
-        tp_names.remove(self._CODE_COLUMN_NAME)
-        for tp_name in tp_names:
-            tp, _ = TradePoint.objects.get_or_create(name=tp_name, customer=self.customer)
-            if df[tp.name].tolist():
-                tp_list.append(tp)
-        return tp_list
-
-    def _parse_products(self, df: pd.DataFrame) -> None:
-        products_from_file = df[self._PRODUCT_COLUMN_NAME].tolist()
-        codes_from_file = df[self._CODE_COLUMN_NAME].tolist()
-
-        # Create products if not exist
-        for row_num in range(len(products_from_file)):
-            customer_product, _ = CustomerProduct.objects.get_or_create(
-                name=products_from_file[row_num],
-                vendor_code=codes_from_file[row_num],
-                customer=self.customer,
-            )
-
-    def _create_orders(self, df: pd.DataFrame, tp_list: list[TradePoint]) -> None:
-        unique_customer_products = []
-        for tp in tp_list:
-            products_in_order = []
-
-            for _, row in df.iterrows():
-                if row[tp.name] > 0:
-                    customer_product = CustomerProduct.objects.get(
-                        name=row[self._PRODUCT_COLUMN_NAME],
-                    )
-                    product_in_order = ProductInOrder(
-                        product=customer_product,
-                        amount=int(row[tp.name]),
-                    )
-                    products_in_order.append(product_in_order)
-
-                    if customer_product not in unique_customer_products:
-                        unique_customer_products.append(customer_product)
-
-            if products_in_order:
-                order = Order(
-                    customer_order=self.customer_order,
-                    trade_point=tp,
-                )
-                order.save()
-                for product_in_order in products_in_order:
-                    product_in_order.order = order
-                    product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-    def parse(self):
-        df = self._read()
-
-        tp_list = self._parse_trade_points(df)
-        self._parse_products(df)
-        self._create_orders(df, tp_list)
-
-
-class OseniParser(Parser):
-    _PRODUCT_COLUMN_NAME = "Номенклатура"
-    _TP_COLUMN_NAME = "Код"
-    _VENDOR_CODE_COLUMN_NAME = "Артикул"
-    _QUANTITY_COLUMN_NAME = "Количество"
-    _SKIPROWS = 7
-    _INCLUDE_COLUMNS = [
-        _VENDOR_CODE_COLUMN_NAME,
-        _TP_COLUMN_NAME,
-        _PRODUCT_COLUMN_NAME,
-        _QUANTITY_COLUMN_NAME,
-    ]
-
-    def _read(self) -> pd.DataFrame:
-        try:
-            df = pd.read_excel(
-                self.file,
-                skiprows=self._SKIPROWS,
-                usecols=self._INCLUDE_COLUMNS,
-                engine="openpyxl",
-            )
-        except Exception as e:
-            print("Не получилось обработать файл", e)
-            raise
-
-        # Заполняем пустые ячейки нулями
-        df = df.fillna(0)
-
-        if df.empty:
-            print("Из файла не загрузилось ни одной строки!")
-
-        return df
-
-    def parse(self):
-        df = self._read()
-        order = None
-        unique_customer_products = []
-        for _, row in df.iterrows():
-            if row[self._VENDOR_CODE_COLUMN_NAME] == "Итого":
-                break
-            if str(row[self._VENDOR_CODE_COLUMN_NAME]) != str(row[self._TP_COLUMN_NAME]):
-                tp, _ = TradePoint.objects.get_or_create(name=row[self._TP_COLUMN_NAME], customer=self.customer)
-                order = Order(customer_order=self.customer_order, trade_point=tp)
-                order.save()
-
-            # TODO: get by unique vendor_code not by name
-            elif row[self._TP_COLUMN_NAME] and order is not None:
-                customer_product, _ = CustomerProduct.objects.get_or_create(
-                    name=row[self._PRODUCT_COLUMN_NAME].strip(),
-                    vendor_code=str(row[self._VENDOR_CODE_COLUMN_NAME]).strip(),
-                    customer=self.customer,
-                )
-                if customer_product not in unique_customer_products:
-                    unique_customer_products.append(customer_product)
-
-                if int(row[self._QUANTITY_COLUMN_NAME]) > 0:
-                    product_in_order = ProductInOrder(
-                        product=customer_product,
-                        amount=int(row[self._QUANTITY_COLUMN_NAME]),
-                        order=order,
-                    )
-                    product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-
-class OseniParserV2(Parser):
-    _PRODUCT_COLUMN_NAME = "Номенклатура"
-    _TP_COLUMN_NAME = "Магазин"
-    _VENDOR_CODE_COLUMN_NAME = "Артикул"
-    _QUANTITY_COLUMN_NAME = "Количество"
-    _SKIPROWS = 0
-    _INCLUDE_COLUMNS = [
-        _VENDOR_CODE_COLUMN_NAME,
-        _TP_COLUMN_NAME,
-        _PRODUCT_COLUMN_NAME,
-        _QUANTITY_COLUMN_NAME,
-    ]
-
-    def _read(self) -> pd.DataFrame:
-        try:
-            df = pd.read_excel(
-                self.file,
-                skiprows=self._SKIPROWS,
-                usecols=self._INCLUDE_COLUMNS,
-                engine="openpyxl",
-            )
-        except Exception as e:
-            print("Не получилось обработать файл", e)
-            raise
-
-        # Заполняем пустые ячейки нулями
-        df = df.fillna(0)
-
-        if df.empty:
-            print("Из файла не загрузилось ни одной строки!")
-
-        return df
-
-    def _parse_products(self, df):
-        pass
-
-    def _create_orders(self, df, tp_list):
-        pass
-
-    def _parse_trade_points(self, df):
-        pass
-
-    def parse(self):
-        df = self._read()
-        order = None
-        unique_customer_products = []
-        tp_name = None
-        for _, row in df.iterrows():
-            if row[self._PRODUCT_COLUMN_NAME] == "Итого:":
-                break
-
-            if tp_name != row[self._TP_COLUMN_NAME]:
-                tp_name = row[self._TP_COLUMN_NAME]
-                tp, _ = TradePoint.objects.get_or_create(name=row[self._TP_COLUMN_NAME], customer=self.customer)
-                order = Order(customer_order=self.customer_order, trade_point=tp)
-                order.save()
-
-            customer_product, _ = CustomerProduct.objects.get_or_create(
-                name=row[self._PRODUCT_COLUMN_NAME].strip(),
-                vendor_code=str(int(row[self._VENDOR_CODE_COLUMN_NAME])).strip(),
-                customer=self.customer,
-            )
-            if customer_product not in unique_customer_products:
-                unique_customer_products.append(customer_product)
-
-            if int(row[self._QUANTITY_COLUMN_NAME]) > 0:
-                product_in_order = ProductInOrder(
-                    product=customer_product,
-                    amount=int(row[self._QUANTITY_COLUMN_NAME]),
-                    order=order,
-                )
-                product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-
-class KruasanParser(Parser):
-    _PRODUCT_COLUMN_NAME = "Напитки"
-    _SKIPROWS = 0
-
-    def _read(self) -> pd.DataFrame:
-        try:
-            df = pd.read_excel(
-                self.file,
-                header=None,
-                skiprows=self._SKIPROWS,
-                engine="openpyxl",
-            )
-        except Exception as e:
-            print("Не получилось обработать файл", e)
-            raise
-
-        # Заполняем пустые ячейки нулями
-        df = df.fillna(0)
-
-        if df.empty:
-            print("Из файла не загрузилось ни одной строки!")
-
-        return df
-
-    def _parse_trade_points(self, df: pd.DataFrame) -> list[TradePoint]:
-        # Удаляем первый столбец (столбец 'A')
-        tp_df = df.iloc[:, 1:]
-        # Оставляем только первые три строки
-        tp_df = tp_df.head(3)
-        tp_list = []
-        for column_name in tp_df.columns:
-            column_data = tp_df[column_name].tolist()
-            tp_name = f"{column_data[1]} ({column_data[0]})"
-            tp, _ = TradePoint.objects.get_or_create(
-                sapcode=column_data[2],
-                customer=self.customer,
-                defaults={"name": tp_name},
-            )
-
-            tp_list.append(tp)
-
-        return tp_list
-
-    def _parse_products(self, df: pd.DataFrame) -> None:
-        # Удаляем вторую и третью строки (индексы 1 и 2)
-        prod_df = df.drop([0, 1, 2])
-        products_from_file = prod_df[0].tolist()
-        # Create products if not exist
-        for row_num in range(len(products_from_file)):
-            CustomerProduct.objects.get_or_create(
-                name=products_from_file[row_num].strip(),
-                customer=self.customer,
-                defaults={"vendor_code": uuid4().hex},
-            )
-
-    def _create_orders(self, df: pd.DataFrame, tp_list: list[TradePoint]) -> None:
-        rename = {}
-        for column_name in df.columns:
-            values = df[column_name].tolist()
-            if column_name == 0:
-                rename[column_name] = values[0]
-                self._PRODUCT_COLUMN_NAME = values[0]
-            else:
-                rename[column_name] = values[2]
-        df = df.rename(columns=rename)
-        df = df.drop([0, 1, 2])
-        unique_customer_products = []
-        for tp in tp_list:
-            products_in_order = []
-
-            for _, row in df.iterrows():
-                if row[tp.sapcode] > 0:
-                    customer_product = CustomerProduct.objects.get(
-                        name=row[self._PRODUCT_COLUMN_NAME],
-                    )
-                    product_in_order = ProductInOrder(
-                        product=customer_product,
-                        amount=int(row[tp.sapcode]),
-                    )
-                    products_in_order.append(product_in_order)
-
-                    if customer_product not in unique_customer_products:
-                        unique_customer_products.append(customer_product)
-
-            if products_in_order:
-                order = Order(
-                    customer_order=self.customer_order,
-                    trade_point=tp,
-                )
-                order.save()
-                for product_in_order in products_in_order:
-                    product_in_order.order = order
-                    product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-    def parse(self):
-        df = self._read()
-        tp_list = self._parse_trade_points(df)
-        self._parse_products(df)
-        self._create_orders(df, tp_list)
-
-
-class BahusParser(Parser):
-    _PRODUCT_COLUMN_NAME = "Товар"
-    _VENDOR_CODE_COLUMN_NAME = "Артикул"
-    _QUANTITY_COLUMN_NAME = "Кол-во"
-    _SKIPROWS = 6
-    _INCLUDE_COLUMNS = [
-        _VENDOR_CODE_COLUMN_NAME,
-        _PRODUCT_COLUMN_NAME,
-        _QUANTITY_COLUMN_NAME,
-    ]
-
-    def _read(self) -> list[pd.DataFrame]:
+    def _iter_lines(self, start: int = 0) -> Iterator[pd.DataFrame]:
+        """
+        Отдаёт таблицу строк заказа (см. backend.orders.ingestion) частями,
+        начиная с части ``start``. Границы частей не должны зависеть от запуска:
+        по ним продолжается прерванный разбор.
+        """
+        raise NotImplementedError("Subclasses must implement _iter_lines method.")
+
+    def parse(self) -> int:
+        """
+        Записывает строки заказа часть за частью, каждую в своей транзакции
+        вместе с отметкой ``CustomerOrder.checkpoint``: ни память, ни транзакция
+        не растут вместе с размером файла, а прерванный разбор продолжается с
+        первой незаписанной части без дублей. В режиме ``ORDER_INGEST_STAGING``
+        части копятся в промежуточной таблице и публикуются в конце одной
+        короткой транзакцией. Возвращает число строк заказа.
+        """
+        customer_order = self.customer_order
+        lock_wait = customer_order.lock_wait
+        for lines in self._iter_lines(start=customer_order.checkpoint):
+            with transaction.atomic():
+                customer_order.lines_count += self.ingestor.ingest(lines)
+                customer_order.checkpoint += 1
+                customer_order.lock_wait = lock_wait + self.ingestor.lock_wait
+                customer_order.save(update_fields=["lines_count", "checkpoint", "lock_wait", "modified"])
+        self.ingestor.publish()
+        return customer_order.lines_count
+
+
+class LayoutParser(Parser):
+    """
+    Парсер формата, описанного в ``backend.orders.layouts.FileLayout``.
+    Классы для конкретных форматов создаются ``layout_parser``.
+    """
+
+    layout: FileLayout
+
+    def _read_archive(self) -> list[str]:
         file_size = os.path.getsize(self.file_path)
         if file_size > 50 * 1024 * 1024:  # 50 MB
             raise Exception("Файл больше 50 МБ.")
@@ -395,182 +131,258 @@ class BahusParser(Parser):
             raise Exception("Файл не является ZIP-архивом.")
         try:
             with zipfile.ZipFile(self.file_path, "r") as z:
-                xlsx_files = [f for f in z.namelist() if f.endswith(".xlsx")]
-                dataframes = [pd.read_excel(z.open(file), header=None, engine="openpyxl") for file in xlsx_files]
-        except zipfile.BadZipFile:
-            print("Файл повреждён или не является правильным ZIP-архивом.")
-        for df in dataframes:
-            continue
-            # logger.debug("Заказчик: {}", df.iat[3, 3])
-        # logger.debug("Адрес: {}", dataframes[0].iat[4, 3])
-
-        return dataframes
-
-    def _parse_trade_points(self, dfs: list[pd.DataFrame]) -> list[TradePoint]:
-        unique_customer_products = []
-        # logger.debug("DFS: {}", dfs)
-        for df in dfs:
-            df = df.fillna(0)
-            match = re.search(r"\".*\"", df.iat[3, 3])
-            if match:
-                tp_name = match.group(0)[1:-1]
-            else:
-                tp_name = df.iat[3, 3]
-            # logger.info("Заказчик: {}", tp_name)
-            # logger.info("Адрес: {}", df.iat[4, 3])
-
-            # Create TP
-            tp, _ = TradePoint.objects.get_or_create(name=tp_name, customer=self.customer)
-            # Create Order
-            order = Order(customer_order=self.customer_order, trade_point=tp)
-            order.save()
-
-            df.drop([0, 1, 2, 3, 4, 5], inplace=True)
-
-            df.columns = df.iloc[0]
-            df.drop(df.index[0], inplace=True)
-
-            df = df.loc[:, self._INCLUDE_COLUMNS]
-            # logger.debug(df)
-
-            for _, row in df.iterrows():
-                # logger.debug(f"Artice: {row[self._VENDOR_CODE_COLUMN_NAME]}")
-                if not row[self._VENDOR_CODE_COLUMN_NAME]:
-                    break
-                customer_product, _ = CustomerProduct.objects.get_or_create(
-                    name=str(row[self._PRODUCT_COLUMN_NAME]).strip(),
-                    vendor_code=str(row[self._VENDOR_CODE_COLUMN_NAME]).strip(),
-                    customer=self.customer,
-                )
-                if customer_product not in unique_customer_products:
-                    unique_customer_products.append(customer_product)
-
-                if int(row[self._QUANTITY_COLUMN_NAME]) > 0:
-                    product_in_order = ProductInOrder(
-                        product=customer_product,
-                        amount=int(row[self._QUANTITY_COLUMN_NAME]),
-                        order=order,
-                    )
-                    product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-        return []
-
-    def _parse_products(self, df: pd.DataFrame) -> None:
-        pass
-
-    def _create_orders(self, df: pd.DataFrame, tp_list: list[TradePoint]) -> None:
-        pass
-
-    def parse(self) -> None:
-        dfs = self._read()
-        _ = self._parse_trade_points(dfs)
-        # tp_list = self._parse_trade_points(dfs)
-        # self._parse_products(df)
-        # self._create_orders(df, tp_list)
-
-
-class ProdstarrParser(Parser):
-    _PRODUCT_COLUMN_NAME = "Контрагент"
-    _SKIPROWS = 5
-
-    def _read(self) -> pd.DataFrame:
-        try:
-            df = pd.read_excel(
-                self.file,
-                skiprows=self._SKIPROWS,
-                engine="openpyxl",
-            )
-            # df = df.drop(df.columns[0], axis=1)  # удаляем первую колонку с Артикулом
-            df = df.drop(0)
-            df = df.drop(df.columns[[1, 2, 3, 4]], axis=1)
-        except Exception as e:
-            print("Не получилось обработать файл", e)
-            raise
-
-        # Заполняем пустые ячейки нулями
-        df = df.fillna(0)
-
-        # logger.debug("df: {}", df)
-
-        if df.empty:
-            print("Из файла не загрузилось ни одной строки!")
-
-        return df
-
-    def _parse_trade_points(self, df: pd.DataFrame) -> list[TradePoint]:
-        tp_list = []
-        tp_names = df.columns.tolist()
-
-        tp_names.remove(self._PRODUCT_COLUMN_NAME)
-        tp_names = [tp_name for tp_name in tp_names if "Unnamed" not in tp_name]
-        for tp_name in tp_names:
-            tp, _ = TradePoint.objects.get_or_create(name=tp_name, customer=self.customer)
-            if any([qty for qty in df[tp_name].tolist()]):
-                tp_list.append(tp)
-        return tp_list
-
-    def _parse_products(self, df: pd.DataFrame) -> None:
-        products_from_file = df[self._PRODUCT_COLUMN_NAME].tolist()
-        # logger.debug("products_from_file: {}", products_from_file)
-
-        # Create products if not exist
-        for row_num in range(len(products_from_file)):
-            customer_product, _ = CustomerProduct.objects.get_or_create(
-                name=products_from_file[row_num],
-                customer=self.customer,
-            )
-
-    def _create_orders(self, df: pd.DataFrame, tp_list: list[TradePoint]) -> None:
-        unique_customer_products = []
-        for tp in tp_list:
-            products_in_order: list[ProductInOrder] = []
-
-            for _, row in df.iterrows():
-                # logger.debug("row: {}", row[tp.name])
-                if row[tp.name] > 0:
-                    customer_product = CustomerProduct.objects.get(
-                        name=row[self._PRODUCT_COLUMN_NAME],
-                    )
-                    product_in_order = ProductInOrder(
-                        product=customer_product,
-                        amount=int(row[tp.name]),
-                    )
-                    products_in_order.append(product_in_order)
-
-                    if customer_product not in unique_customer_products:
-                        unique_customer_products.append(customer_product)
-
-            if products_in_order:
-                order = Order(
-                    customer_order=self.customer_order,
-                    trade_point=tp,
-                )
-                order.save()
-                for product_in_order in products_in_order:
-                    product_in_order.order = order
-                    product_in_order.save()
-        self.customer_order.products.add(*unique_customer_products)
-
-    def parse(self):
-        df = self._read()
-
-        tp_list = self._parse_trade_points(df)
-        self._parse_products(df)
-        self._create_orders(df, tp_list)
+                return [f for f in z.namelist() if f.endswith(".xlsx")]
+        except zipfile.BadZipFile as e:
+            raise Exception("Файл повреждён или не является правильным ZIP-архивом.") from e
+
+    def _iter_lines(self, start: int = 0) -> Iterator[pd.DataFrame]:
+        if self.layout.archive:
+            # Каждый файл архива - отдельная часть, записанные файлы не разбираются заново
+            yield from self._parse_archive(self._read_archive()[start:])
+            return
+
+        # Границы частей зависят только от файла, ORDER_CHUNK_ROWS и ORDER_CHUNK_BYTES,
+        # поэтому при повторном запуске записанные части только читаются, но не разбираются
+        empty = True
+        chunks = compile_layout(self.layout).iter_lines(
+            self.file,
+            reader=self.reader,
+            chunk_bytes=settings.ORDER_CHUNK_BYTES,
+            chunk_rows=settings.ORDER_CHUNK_ROWS,
+            start=start,
+        )
+        for lines in chunks:
+            empty = empty and lines.empty
+            yield lines
+
+        if empty and start == 0:
+            logger.warning("Из файла общего заказа %s не загрузилось ни одной строки", self.customer_order.pk)
+
+    def _parse_archive(self, members: list[str]) -> Iterator[pd.DataFrame]:
+        # Файлы архива независимы и разбираются параллельно, а запись в БД остаётся в этом процессе
+        return map_in_processes(
+            _parse_archive_member,
+            [(self.file_path, member, self.reader, self.layout) for member in members],
+            self.processes,
+        )
+
+
+def _parse_archive_member(file_path: str, member: str, reader: Reader, layout: FileLayout) -> pd.DataFrame:
+    compiled = compile_layout(layout)
+    with zipfile.ZipFile(file_path, "r") as z, z.open(member) as file:
+        sheet = compiled.read(file, reader=reader)
+    return compiled(sheet)
+
+
+@lru_cache
+def layout_parser(customer_order_code: str, layout: FileLayout) -> type[LayoutParser]:
+    """Класс парсера для формата клиента, создаётся один раз на формат."""
+    return type(
+        f"LayoutParser[{customer_order_code}]",
+        (LayoutParser,),
+        {
+            "layout": layout,
+            "_TRADE_POINT_KEY": layout.trade_point_key,
+            "_PRODUCT_KEY": layout.product_key,
+            "_ATTACH_LISTED_PRODUCTS": layout.attach_listed_products,
+        },
+    )
 
 
 class ParserFactory:
+    def create_reader(self, customer_order_code: str) -> Reader:
+        engine = settings.ORDER_FILE_READERS.get(customer_order_code, settings.ORDER_FILE_READER)
+        return get_reader(engine)
+
     def create_parser(self, customer_order_code: str) -> type[Parser]:
-        if customer_order_code == "stroytorgovlya":
-            return StroiTorgovlyaParser
-        elif customer_order_code == "oseni":
-            return OseniParserV2
-        elif customer_order_code == "kruasan":
-            return KruasanParser
-        elif customer_order_code == "prodstarr":
-            return ProdstarrParser
-        elif customer_order_code == "lavki-bakhusa":
-            return BahusParser
-        else:
-            raise ValueError("Customer parser does not exist.")
+        if customer_order_code in LAYOUTS:
+            return layout_parser(customer_order_code, LAYOUTS[customer_order_code])
+        raise ValueError("Customer parser does not exist.")
+
+
+def parse_customer_order(customer_order: CustomerOrder) -> int:
+    """
+    Разбирает файл общего заказа, отмечая ход обработки в ``CustomerOrder.status``.
+    Файл пишется частями (см. ``Parser.parse``). Если разбор не уложился в
+    мягкий лимит времени задачи, записанные части сохраняются и следующий
+    запуск продолжает с места остановки. При любой другой ошибке записанное
+    удаляется, а текст ошибки сохраняется в заказе.
+    """
+    customer_order.status = CustomerOrder.Status.RUNNING
+    customer_order.error = ""
+    customer_order.save(update_fields=["status", "error", "modified"])
+    try:
+        parser = ParserFactory().create_parser(customer_order.customer.code)(customer_order)
+        lines_count = parser.parse()
+    except SoftTimeLimitExceeded:
+        raise
+    except Exception as e:
+        fail_customer_order(customer_order, e)
+        raise
+
+    customer_order.status = CustomerOrder.Status.DONE
+    customer_order.lines_count = lines_count
+    customer_order.orders_count = customer_order.tp_orders.count()
+    customer_order.save(update_fields=["status", "lines_count", "orders_count", "modified"])
+    return lines_count
+
+
+def reingest_customer_order(customer_order: CustomerOrder) -> dict[str, int]:
+    """
+    Разбирает заменённый файл уже разобранного заказа и приводит к нему
+    записанные заказы (см. ``OrderIngestor.reconcile``): меняются только
+    отличающиеся строки, поэтому исправление нескольких строк большого файла
+    не переписывает заказ целиком. При ошибке прежний результат остаётся, а
+    текст ошибки сохраняется в заказе. Возвращает число вставленных,
+    изменённых и удалённых строк.
+    """
+    customer_order.status = CustomerOrder.Status.RUNNING
+    customer_order.error = ""
+    customer_order.save(update_fields=["status", "error", "modified"])
+    try:
+        parser = ParserFactory().create_parser(customer_order.customer.code)(customer_order)
+        ingestor = parser.ingestor
+        resolved = []
+        for lines in parser._iter_lines():
+            with transaction.atomic():
+                resolved.append(ingestor.resolve(lines))
+        with transaction.atomic():
+            changes = ingestor.reconcile(pd.concat(resolved) if resolved else pd.DataFrame(columns=RESOLVED_COLUMNS))
+    except Exception as e:
+        customer_order.status = CustomerOrder.Status.FAILED
+        customer_order.error = str(e)
+        customer_order.save(update_fields=["status", "error", "modified"])
+        raise
+
+    customer_order.status = CustomerOrder.Status.DONE
+    customer_order.lines_count = sum(len(lines) for lines in resolved)
+    customer_order.orders_count = customer_order.tp_orders.count()
+    customer_order.save(update_fields=["status", "lines_count", "orders_count", "modified"])
+    return changes
+
+
+def preview_customer_order(customer: Customer, file: UploadedFile) -> dict:
+    """
+    Разбирает загруженный файл целиком, ничего не записывая в БД, и
+    возвращает сводку ``OrderPreview``: торговые точки с числом строк и суммой,
+    новые и известные товары, число строк заказа.
+    """
+    parser_class = ParserFactory().create_parser(customer.code)
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(file.name or "")[1]) as temp:
+        for chunk in file.chunks():
+            temp.write(chunk)
+        temp.flush()
+        temp.seek(0)
+        # Предпросмотр идёт в процессе веб-сервера, поэтому файлы архива разбираются без пула
+        parser = parser_class(CustomerOrder(customer=customer, file=File(temp, name=temp.name)), processes=1)
+        preview = OrderPreview(customer, parser._TRADE_POINT_KEY, parser._PRODUCT_KEY)
+        for lines in parser._iter_lines():
+            preview.add(lines)
+    return preview.summary()
+
+
+def build_order_matrix(customer_order: CustomerOrder, dense: bool = False) -> dict:
+    """
+    Собирает заказ в виде матрицы "торговая точка x товар" одним агрегирующим
+    запросом: торговые точки и товары перечисляются по одному разу, а
+    количества - тройками (номер точки, номер товара, количество) или, при
+    ``dense``, строкой количеств на каждую точку.
+    """
+    cells = (
+        ProductInOrder.objects.filter(order__customer_order=customer_order)
+        .values_list(
+            "order__trade_point_id",
+            "order__trade_point__name",
+            "order__trade_point__sapcode",
+            "product_id",
+            "product__name",
+            "product__vendor_code",
+            "product__base_product__name",
+            "product__base_product__vendor_code",
+            "product__base_product__amount_in_pack",
+        )
+        .annotate(amount=Sum("amount"))
+        # Без сортировки модели, иначе id строки попадёт в GROUP BY
+        .order_by()
+    )
+
+    tp_by_id: dict[int, dict] = {}
+    product_by_id: dict[int, dict] = {}
+    amounts = []
+    for tp_id, tp_name, sapcode, product_id, name, vendor_code, base_name, base_vendor_code, in_pack, amount in cells:
+        tp_by_id.setdefault(tp_id, {"id": tp_id, "name": tp_name, "sapcode": sapcode})
+        product_by_id.setdefault(
+            product_id,
+            {
+                "id": product_id,
+                "product_name": name,
+                "vendor_code": vendor_code,
+                "base_product_name": base_name or "",
+                "base_vendor_code": base_vendor_code or "",
+                "amount_in_pack": in_pack or 0,
+            },
+        )
+        amounts.append((tp_id, product_id, amount))
+
+    trade_points = sorted(tp_by_id.values(), key=lambda trade_point: (trade_point["name"], trade_point["id"]))
+    products = sorted(product_by_id.values(), key=lambda product: (product["product_name"], product["id"]))
+    tp_index = {trade_point["id"]: i for i, trade_point in enumerate(trade_points)}
+    product_index = {product["id"]: i for i, product in enumerate(products)}
+    if dense:
+        matrix = [[0] * len(products) for _ in trade_points]
+        for tp_id, product_id, amount in amounts:
+            matrix[tp_index[tp_id]][product_index[product_id]] = amount
+    else:
+        matrix = sorted([tp_index[tp_id], product_index[product_id], amount] for tp_id, product_id, amount in amounts)
+    return {"trade_points": trade_points, "products": products, "dense": dense, "amounts": matrix}
+
+
+def fail_customer_order(customer_order: CustomerOrder, error: Exception | str) -> None:
+    """Удаляет частично записанный результат разбора и отмечает заказ как ошибочный."""
+    with transaction.atomic():
+        customer_order.tp_orders.all().delete()
+        customer_order.products.clear()
+        StagedProductInOrder.objects.filter(customer_order=customer_order).delete()
+    customer_order.status = CustomerOrder.Status.FAILED
+    customer_order.error = str(error)
+    customer_order.lines_count = 0
+    customer_order.checkpoint = 0
+    customer_order.save(update_fields=["status", "error", "lines_count", "checkpoint", "modified"])
+
+
+def find_duplicate_customer_order(customer: Customer, file_hash: str) -> CustomerOrder | None:
+    """Последний успешный или ещё обрабатываемый заказ клиента с тем же файлом."""
+    return (
+        CustomerOrder.objects.filter(customer=customer, file_hash=file_hash)
+        .exclude(status=CustomerOrder.Status.FAILED)
+        .order_by("-created")
+        .first()
+    )
+
+
+def relink_customer_order(source: CustomerOrder, target: CustomerOrder) -> None:
+    """
+    Переносит результат разбора ``source`` в новый заказ ``target`` с тем же
+    файлом: заказы на торговые точки и товары копируются пачкой, без разбора.
+    """
+    target.products.add(*source.products.values_list("id", flat=True))
+    trade_points = dict(source.tp_orders.values_list("id", "trade_point_id"))
+    Order.objects.bulk_create(
+        [Order(customer_order=target, trade_point_id=tp_id) for tp_id in trade_points.values()],
+        batch_size=BATCH_SIZE,
+    )
+    orders = dict(target.tp_orders.values_list("trade_point_id", "id"))
+    ProductInOrder.objects.bulk_create(
+        (
+            ProductInOrder(order_id=orders[trade_points[order_id]], product_id=product_id, amount=amount)
+            for order_id, product_id, amount in ProductInOrder.objects.filter(order__customer_order=source)
+            .values_list("order_id", "product_id", "amount")
+            .iterator()
+        ),
+        batch_size=BATCH_SIZE,
+    )
+
+    target.status = CustomerOrder.Status.DONE
+    target.lines_count = source.lines_count
+    target.orders_count = source.orders_count
+    target.save(update_fields=["status", "lines_count", "orders_count", "modified"])
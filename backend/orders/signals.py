@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from backend.orders.lookups import invalidate_index
+from backend.orders.models import CustomerProduct, TradePoint
+
+
+@receiver(post_save, sender=TradePoint)
+@receiver(post_delete, sender=TradePoint)
+@receiver(post_save, sender=CustomerProduct)
+@receiver(post_delete, sender=CustomerProduct)
+def invalidate_customer_index(sender, instance, **kwargs):
+    invalidate_index(instance.customer_id)
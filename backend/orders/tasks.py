@@ -0,0 +1,91 @@
+from collections import defaultdict
+
+from celery import chain, group
+from celery.exceptions import SoftTimeLimitExceeded
+from django.db import transaction
+from django.db.models import QuerySet
+
+from backend.orders.models import CustomerOrder
+from backend.orders.services import (
+    fail_customer_order,
+    parse_customer_order,
+    reingest_customer_order,
+)
+from config import celery_app
+
+
+@celery_app.task(bind=True, max_retries=10)
+def create_customer_order_task(self, customer_order_id: int):
+    """
+    Разбирает файл общего заказа и создаёт заказы на торговые точки.
+    Если разбор не уложился в лимит времени, задача перезапускается и
+    продолжает с последней записанной части файла.
+    """
+    customer_order = CustomerOrder.objects.select_related("customer").get(pk=customer_order_id)
+    try:
+        return parse_customer_order(customer_order)
+    except SoftTimeLimitExceeded as e:
+        if self.request.retries >= self.max_retries:
+            fail_customer_order(customer_order, "Разбор файла не уложился в отведённое время.")
+            raise
+        raise self.retry(exc=e, countdown=0)
+
+
+@celery_app.task
+def reingest_customer_order_task(customer_order_id: int):
+    """Приводит заказы к заменённому файлу общего заказа, меняя только отличающиеся строки."""
+    customer_order = CustomerOrder.objects.select_related("customer").get(pk=customer_order_id)
+    return reingest_customer_order(customer_order)
+
+
+@celery_app.task
+def reparse_customer_order_task(customer_order_id: int):
+    """
+    Перестраивает заказы по сохранённому файлу в ходе массового повторного
+    разбора. Ошибка отмечается в заказе и, как и удалённый заказ, не
+    прерывает разбор следующих заказов той же очереди.
+    """
+    try:
+        customer_order = CustomerOrder.objects.select_related("customer").get(pk=customer_order_id)
+    except CustomerOrder.DoesNotExist:
+        # Заказ удалили, пока он ждал своей очереди
+        return None
+    try:
+        return reingest_customer_order(customer_order)
+    except Exception:
+        # Текст ошибки сохранён в заказе
+        return None
+
+
+def reparse_customer_orders(customer_orders: QuerySet, lanes: int) -> tuple[list[int], int]:
+    """
+    Ставит общие заказы в очередь на повторный разбор сохранённых файлов и
+    возвращает их id и число пропущенных заказов. Заказы делятся на ``lanes``
+    параллельных очередей (цепочек задач), поэтому одновременно разбирается не
+    больше ``lanes`` файлов. Все заказы клиента попадают в одну очередь и
+    разбираются по порядку создания, как при первой загрузке. Заказы, которые
+    ещё ждут разбора или разбираются, пропускаются: их строки пишет своя задача.
+    """
+    with transaction.atomic():
+        selected = customer_orders.count()
+        # Строки заблокированы до постановки в очередь, поэтому замена файла в это время ждёт и получает отказ
+        reparsable = (
+            customer_orders.filter(status__in=(CustomerOrder.Status.DONE, CustomerOrder.Status.FAILED))
+            .select_for_update(skip_locked=True, of=("self",))
+            .order_by("created", "id")
+        )
+        by_customer = defaultdict(list)
+        for pk, customer_id in reparsable.values_list("id", "customer_id"):
+            by_customer[customer_id].append(pk)
+
+        # Самые загруженные клиенты распределяются первыми, каждый - в наименее загруженную очередь
+        queues: list[list[int]] = [[] for _ in range(max(1, lanes))]
+        for ids in sorted(by_customer.values(), key=len, reverse=True):
+            min(queues, key=len).extend(ids)
+
+        queued = [pk for ids in queues for pk in ids]
+        CustomerOrder.objects.filter(id__in=queued).update(status=CustomerOrder.Status.QUEUED, error="")
+        canvas = group([chain([reparse_customer_order_task.si(pk) for pk in ids]) for ids in queues if ids])
+        if queued:
+            transaction.on_commit(canvas.apply_async)
+    return queued, selected - len(queued)
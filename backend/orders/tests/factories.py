@@ -0,0 +1,103 @@
+import io
+import zipfile
+
+from factory import Faker, Sequence, SubFactory, post_generation
+from factory.django import DjangoModelFactory, FileField
+from openpyxl import Workbook
+
+from backend.orders.models import Customer, CustomerOrder, CustomerProduct, Product, ProductInOrder, TradePoint
+
+# Файлы заказов клиентов в минимальном виде
+STROITORGOVLYA: list[list] = [
+    ["Заказ"],
+    ["Артикул", "Второе наименование товара", "Магазин 1", "Магазин 2"],
+    ["001", "Цемент", 5, None],
+    ["002", "Песок", None, 3],
+    ["003", "Гравий", None, None],
+]
+
+OSENI: list[list] = [
+    ["Артикул", "Магазин", "Номенклатура", "Количество"],
+    [101, "Осень 1", " Яблоки ", 4],
+    [102, "Осень 1", "Груши", 0],
+    [101, "Осень 2", "Яблоки", 2],
+    [None, None, "Итого:", 6],
+]
+
+
+def make_xlsx(rows: list[list]) -> bytes:
+    """Содержимое .xlsx с одним листом из строк ``rows``."""
+    workbook = Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+
+def make_zip(files: dict[str, bytes]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def order_lines(customer_order: CustomerOrder) -> set[tuple]:
+    """Записанные строки общего заказа: (торговая точка, товар, количество)."""
+    return set(
+        ProductInOrder.objects.filter(order__customer_order=customer_order).values_list(
+            "order__trade_point__name", "product__name", "amount"
+        )
+    )
+
+
+class CustomerFactory(DjangoModelFactory):
+    name = Faker("company")
+
+    @post_generation
+    def code(self, create: bool, extracted: str | None, **kwargs):
+        # AutoSlugField пересоздаёт код из названия при добавлении клиента
+        if extracted:
+            self.code = extracted
+            if create:
+                self.save(update_fields=["code"])
+
+    class Meta:
+        model = Customer
+        skip_postgeneration_save = True
+
+
+class TradePointFactory(DjangoModelFactory):
+    name = Faker("street_name")
+    customer = SubFactory(CustomerFactory)
+
+    class Meta:
+        model = TradePoint
+
+
+class ProductFactory(DjangoModelFactory):
+    name = Faker("word")
+    vendor_code = Sequence(lambda n: f"B{n:06d}")
+    amount_in_pack = 6
+
+    class Meta:
+        model = Product
+
+
+class CustomerProductFactory(DjangoModelFactory):
+    name = Faker("word")
+    vendor_code = Sequence(lambda n: f"{n:06d}")
+    customer = SubFactory(CustomerFactory)
+
+    class Meta:
+        model = CustomerProduct
+
+
+class CustomerOrderFactory(DjangoModelFactory):
+    customer = SubFactory(CustomerFactory)
+    file = FileField(filename="order.xlsx")
+
+    class Meta:
+        model = CustomerOrder
@@ -0,0 +1,127 @@
+from io import StringIO
+
+import pytest
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+
+from backend.orders import tasks
+from backend.orders.management.commands import reparse_customer_orders
+from backend.orders.models import CustomerOrder
+from backend.orders.tests.factories import (
+    OSENI,
+    STROITORGOVLYA,
+    CustomerFactory,
+    CustomerOrderFactory,
+    make_xlsx,
+    order_lines,
+)
+
+pytestmark = pytest.mark.django_db
+
+
+def _order(customer, rows: list[list]):
+    return CustomerOrderFactory(
+        customer=customer, file=ContentFile(make_xlsx(rows), name="order.xlsx"), status=CustomerOrder.Status.FAILED
+    )
+
+
+# Команда работает вне транзакции: задачи уходят в очередь сразу, и --wait их дожидается
+@pytest.mark.django_db(transaction=True)
+def test_reparse_rebuilds_orders_from_files(settings):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    stroytorgovlya = _order(CustomerFactory(code="stroytorgovlya"), STROITORGOVLYA)
+    oseni = _order(CustomerFactory(code="oseni"), OSENI)
+    broken = _order(stroytorgovlya.customer, [["Нет шапки"]])
+    stdout = StringIO()
+
+    call_command("reparse_customer_orders", "--status", "failed", "--wait", "--interval", "0", stdout=stdout)
+
+    assert order_lines(stroytorgovlya) == {("Магазин 1", "Цемент", 5), ("Магазин 2", "Песок", 3)}
+    assert order_lines(oseni) == {("Осень 1", "Яблоки", 4), ("Осень 2", "Яблоки", 2)}
+    broken.refresh_from_db()
+    assert broken.status == CustomerOrder.Status.FAILED
+    assert "Разобрано 3 из 3, с ошибкой 1." in stdout.getvalue()
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reparse_wait_ignores_deleted_orders(settings, monkeypatch):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    kept = _order(customer, STROITORGOVLYA)
+    deleted = _order(customer, STROITORGOVLYA)
+    reparse = reparse_customer_orders.reparse_customer_orders
+
+    def reparse_and_delete(customer_orders, lanes):
+        queued = reparse(customer_orders, lanes)
+        deleted.delete()
+        return queued
+
+    monkeypatch.setattr(reparse_customer_orders, "reparse_customer_orders", reparse_and_delete)
+    stdout = StringIO()
+
+    call_command("reparse_customer_orders", "--wait", "--interval", "0", stdout=stdout)
+
+    kept.refresh_from_db()
+    assert kept.status == CustomerOrder.Status.DONE
+    assert "Разобрано 1 из 1, с ошибкой 0." in stdout.getvalue()
+
+
+def test_reparse_continues_after_deleted_order(settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    deleted = _order(customer, STROITORGOVLYA)
+    kept = _order(customer, STROITORGOVLYA)
+    with django_capture_on_commit_callbacks() as callbacks:
+        tasks.reparse_customer_orders(CustomerOrder.objects.all(), lanes=1)
+
+    # Первый заказ очереди удалили, пока он ждал разбора
+    deleted.delete()
+    for callback in callbacks:
+        callback()
+
+    kept.refresh_from_db()
+    assert kept.status == CustomerOrder.Status.DONE
+    assert order_lines(kept) == {("Магазин 1", "Цемент", 5), ("Магазин 2", "Песок", 3)}
+
+
+def test_reparse_keeps_customer_orders_in_order(settings, monkeypatch, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customers = [CustomerFactory(code="stroytorgovlya") for _ in range(3)]
+    orders = [
+        CustomerOrderFactory(customer=customer, status=CustomerOrder.Status.DONE)
+        for _ in range(3)
+        for customer in customers
+    ]
+    parsed = []
+    monkeypatch.setattr(tasks, "reingest_customer_order", lambda customer_order: parsed.append(customer_order))
+
+    with django_capture_on_commit_callbacks(execute=True):
+        ids, skipped = tasks.reparse_customer_orders(CustomerOrder.objects.all(), lanes=2)
+
+    assert sorted(ids) == sorted(order.pk for order in orders)
+    assert skipped == 0
+    assert CustomerOrder.objects.filter(status=CustomerOrder.Status.QUEUED).count() == len(orders)
+    for customer in customers:
+        assert [order.pk for order in parsed if order.customer_id == customer.pk] == [
+            order.pk for order in orders if order.customer_id == customer.pk
+        ]
+
+
+@pytest.mark.parametrize("order_status", [CustomerOrder.Status.QUEUED, CustomerOrder.Status.RUNNING])
+def test_reparse_skips_orders_being_parsed(settings, monkeypatch, order_status, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    # Свежая загрузка: её строки пишет create_customer_order_task
+    uploaded = CustomerOrderFactory(customer=customer, status=order_status)
+    done = CustomerOrderFactory(customer=customer, status=CustomerOrder.Status.DONE)
+    parsed = []
+    monkeypatch.setattr(tasks, "reingest_customer_order", lambda customer_order: parsed.append(customer_order.pk))
+    stdout = StringIO()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        call_command("reparse_customer_orders", stdout=stdout)
+
+    assert parsed == [done.pk]
+    uploaded.refresh_from_db()
+    assert uploaded.status == order_status
+    assert "Пропущено заказов, которые ещё ждут разбора или разбираются: 1." in stdout.getvalue()
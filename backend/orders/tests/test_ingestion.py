@@ -0,0 +1,166 @@
+import pytest
+
+from backend.orders.ingestion import (
+    AMOUNT,
+    PRODUCT,
+    SAPCODE,
+    TRADE_POINT,
+    VENDOR_CODE,
+    OrderIngestor,
+    StagingIngestor,
+    bulk_insert,
+    make_lines,
+)
+from backend.orders.models import CustomerProduct, Order, ProductInOrder, StagedProductInOrder, TradePoint
+from backend.orders.tests.factories import CustomerOrderFactory, CustomerProductFactory, TradePointFactory
+
+pytestmark = pytest.mark.django_db
+
+
+def _lines(n_trade_points: int, n_products: int):
+    return make_lines(
+        {
+            TRADE_POINT: f"Магазин {tp}",
+            PRODUCT: f"Товар {product}",
+            VENDOR_CODE: f"{product:05d}",
+            AMOUNT: (tp + product) % 3,
+        }
+        for tp in range(n_trade_points)
+        for product in range(n_products)
+    )
+
+
+def test_ingest_creates_missing_objects():
+    customer_order = CustomerOrderFactory()
+    lines = _lines(3, 4)
+
+    written = OrderIngestor(customer_order).ingest(lines)
+
+    assert written == int((lines[AMOUNT] > 0).sum())
+    assert TradePoint.objects.filter(customer=customer_order.customer).count() == 3
+    assert CustomerProduct.objects.filter(customer=customer_order.customer).count() == 4
+    assert Order.objects.filter(customer_order=customer_order).count() == 3
+    assert ProductInOrder.objects.filter(order__customer_order=customer_order).count() == written
+    assert customer_order.products.count() == 4
+
+
+def test_ingest_reuses_existing_objects():
+    customer_order = CustomerOrderFactory()
+    tp = TradePointFactory(customer=customer_order.customer, name="Магазин 0")
+    product = CustomerProductFactory(customer=customer_order.customer, name="Товар 1", vendor_code="00001")
+
+    OrderIngestor(customer_order).ingest(_lines(1, 2))
+
+    assert TradePoint.objects.filter(customer=customer_order.customer).get() == tp
+    line = ProductInOrder.objects.get(order__customer_order=customer_order)
+    assert line.product == product
+    assert line.order.trade_point == tp
+    assert line.amount == 1
+
+
+def test_ingest_by_sapcode_and_name_only():
+    customer_order = CustomerOrderFactory()
+    TradePointFactory(customer=customer_order.customer, name="Старое название", sapcode="S1")
+    lines = make_lines(
+        [
+            {TRADE_POINT: "Новое название", SAPCODE: "S1", PRODUCT: "Круассан", VENDOR_CODE: "a", AMOUNT: 2},
+            {TRADE_POINT: "Новое название", SAPCODE: "S1", PRODUCT: "Круассан", VENDOR_CODE: "b", AMOUNT: 1},
+        ]
+    )
+
+    OrderIngestor(customer_order, trade_point_key="sapcode", product_key=("name",)).ingest(lines)
+
+    assert TradePoint.objects.filter(customer=customer_order.customer).count() == 1
+    assert CustomerProduct.objects.filter(customer=customer_order.customer).count() == 1
+    assert ProductInOrder.objects.filter(order__customer_order=customer_order).count() == 2
+
+
+def test_ingest_query_count_does_not_depend_on_size(django_assert_max_num_queries):
+    customer_order = CustomerOrderFactory()
+
+    # Включая повторную проверку недостающих торговых точек и товаров под блокировкой клиента
+    with django_assert_max_num_queries(14):
+        OrderIngestor(customer_order).ingest(_lines(30, 40))
+
+
+def test_lines_schema():
+    lines = make_lines(
+        [
+            {TRADE_POINT: "Магазин", PRODUCT: "Хлеб", VENDOR_CODE: 101, AMOUNT: "2"},
+            {TRADE_POINT: "Магазин", PRODUCT: "Соль", VENDOR_CODE: None, AMOUNT: None},
+        ]
+    )
+
+    assert lines.dtypes.to_dict() == {
+        TRADE_POINT: "category",
+        SAPCODE: "category",
+        PRODUCT: "category",
+        VENDOR_CODE: "category",
+        AMOUNT: "int32",
+    }
+    assert lines[VENDOR_CODE].tolist()[0] == "101"
+    assert lines[VENDOR_CODE].isna().tolist() == [False, True]
+    assert lines[AMOUNT].tolist() == [2, 0]
+
+
+def test_ingest_keeps_missing_vendor_code():
+    customer_order = CustomerOrderFactory()
+    lines = make_lines([{TRADE_POINT: "Магазин", PRODUCT: "Хлеб", VENDOR_CODE: None, AMOUNT: 1}])
+
+    OrderIngestor(customer_order, product_key=("name",)).ingest(lines)
+
+    assert CustomerProduct.objects.get(customer=customer_order.customer).vendor_code is None
+
+
+def test_staging_ingestor_publishes_on_demand():
+    customer_order = CustomerOrderFactory()
+    lines = _lines(3, 4)
+    ingestor = StagingIngestor(customer_order)
+
+    written = ingestor.ingest(lines.iloc[:6]) + ingestor.ingest(lines.iloc[6:])
+
+    assert not Order.objects.filter(customer_order=customer_order).exists()
+    assert StagedProductInOrder.objects.filter(customer_order=customer_order).count() == written
+
+    ingestor.publish()
+
+    assert not StagedProductInOrder.objects.exists()
+    assert Order.objects.filter(customer_order=customer_order).count() == 3
+    ordered = lines.loc[lines[AMOUNT] > 0]
+    assert set(
+        ProductInOrder.objects.filter(order__customer_order=customer_order).values_list(
+            "order__trade_point__name", "product__name", "amount"
+        )
+    ) == set(zip(ordered[TRADE_POINT], ordered[PRODUCT], ordered[AMOUNT]))
+    assert customer_order.products.count() == 4
+
+
+def test_bulk_insert():
+    # В PostgreSQL строки пишутся через COPY, на других базах - через bulk_create
+    customer_order = CustomerOrderFactory()
+    tp = TradePointFactory(customer=customer_order.customer)
+    products = CustomerProductFactory.create_batch(3, customer=customer_order.customer)
+    order = Order.objects.create(customer_order=customer_order, trade_point=tp)
+
+    bulk_insert(
+        ProductInOrder, ["order_id", "product_id", "amount"], ((order.pk, p.pk, i) for i, p in enumerate(products))
+    )
+
+    assert list(ProductInOrder.objects.values_list("product_id", "amount")) == [
+        (p.pk, i) for i, p in enumerate(products)
+    ]
+
+
+def test_ingest_rechecks_missing_objects_under_lock():
+    customer_order = CustomerOrderFactory()
+    ingestor = OrderIngestor(customer_order)
+    # Индекс загружен до того, как параллельный разбор создал торговую точку и товар
+    ingestor._trade_point_index()
+    ingestor._product_index()
+    tp = TradePointFactory(customer=customer_order.customer, name="Магазин 0")
+    product = CustomerProductFactory(customer=customer_order.customer, name="Товар 0", vendor_code="00000")
+
+    ingestor.ingest(make_lines([{TRADE_POINT: "Магазин 0", PRODUCT: "Товар 0", VENDOR_CODE: "00000", AMOUNT: 1}]))
+
+    assert TradePoint.objects.filter(customer=customer_order.customer).get() == tp
+    assert CustomerProduct.objects.filter(customer=customer_order.customer).get() == product
@@ -0,0 +1,98 @@
+import io
+
+import pandas as pd
+import pytest
+
+from backend.orders.ingestion import AMOUNT, PRODUCT, TRADE_POINT, VENDOR_CODE
+from backend.orders.layouts import FileLayout, compile_layout
+from backend.orders.tests.factories import make_xlsx
+
+
+def _extract(layout: FileLayout, rows: list[list]) -> pd.DataFrame:
+    compiled = compile_layout(layout)
+    return compiled(compiled.read(io.BytesIO(make_xlsx(rows))))
+
+
+def test_wide_layout():
+    layout = FileLayout(product_column="Товар", vendor_code_column="Код", ignore_columns=("Итого",))
+    lines = _extract(
+        layout,
+        [
+            ["Заказ", None, None, None, None],
+            ["Код", "Товар", "ТТ 1", "Итого", None],
+            [1, " Хлеб ", 2, 2, None],
+            [2, "Соль", None, 0, None],
+        ],
+    )
+
+    assert lines[[TRADE_POINT, PRODUCT, VENDOR_CODE, AMOUNT]].values.tolist() == [
+        ["ТТ 1", "Хлеб", "1", 2],
+        ["ТТ 1", "Соль", "2", 0],
+    ]
+
+
+def test_long_layout_stops_at_total_row():
+    layout = FileLayout(
+        product_column="Товар",
+        trade_point_column="Точка",
+        quantity_column="Кол-во",
+        stop_column="Товар",
+        stop_values=("Итого:",),
+    )
+    lines = _extract(layout, [["Точка", "Товар", "Кол-во"], ["ТТ", "Хлеб", 1], [None, "Итого:", 1], ["ТТ", "Соль", 5]])
+
+    assert lines[[TRADE_POINT, PRODUCT, AMOUNT]].values.tolist() == [["ТТ", "Хлеб", 1]]
+
+
+def test_missing_header_column():
+    layout = FileLayout(product_column="Товар")
+
+    with pytest.raises(ValueError, match="Товар"):
+        _extract(layout, [["Название", "ТТ"], ["Хлеб", 1]])
+
+
+def test_header_found_after_extra_rows():
+    layout = FileLayout(product_column="Товар", trade_point_column="Точка", quantity_column="Кол-во")
+    rows: list[list] = [["Точка", "Товар", "Кол-во"], ["ТТ", "Хлеб", 1]]
+
+    # Клиент добавил строки над шапкой - разбор не меняется
+    lines = _extract(layout, [["Заказ от 01.01"], [None], ["Точка"], *rows])
+
+    assert lines[[TRADE_POINT, PRODUCT, AMOUNT]].values.tolist() == [["ТТ", "Хлеб", 1]]
+
+
+def test_header_by_position_uses_skiprows():
+    layout = FileLayout(skiprows=1, header_rows=2, product_column=0, trade_point_name="{1} ({0})")
+
+    lines = _extract(layout, [["Заказ"], ["Центр", "Север"], [None, "ТТ 1"], ["Хлеб", 3]])
+
+    assert lines[[TRADE_POINT, PRODUCT, AMOUNT]].values.tolist() == [["ТТ 1 (Север)", "Хлеб", 3]]
+
+
+def test_iter_lines_does_not_extract_skipped_chunks(monkeypatch):
+    layout = FileLayout(
+        product_column="Товар",
+        trade_point_column="Точка",
+        quantity_column="Кол-во",
+        stop_column="Товар",
+        stop_values=("Итого:",),
+    )
+    content = make_xlsx(
+        [["Точка", "Товар", "Кол-во"], ["ТТ", "Хлеб", 1], ["ТТ", "Соль", 2], ["ТТ", "Мука", 3], [None, "Итого:", 6]]
+    )
+    compiled = compile_layout(layout)
+    extracted = []
+    extract = compiled._extract
+
+    def counting_extract(sheet, data):
+        extracted.append(len(data))
+        return extract(sheet, data)
+
+    monkeypatch.setattr(compiled, "_extract", counting_extract)
+
+    chunks = list(compiled.iter_lines(io.BytesIO(content), chunk_rows=1, start=2))
+
+    assert [chunk[PRODUCT].tolist() for chunk in chunks] == [["Мука"], []]
+    assert len(extracted) == 2
+    # Стоп-значение в уже записанной части - разбирать больше нечего
+    assert list(compiled.iter_lines(io.BytesIO(content), chunk_rows=1, start=5)) == []
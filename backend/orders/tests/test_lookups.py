@@ -0,0 +1,62 @@
+import pytest
+
+from backend.orders.ingestion import AMOUNT, PRODUCT, TRADE_POINT, VENDOR_CODE, OrderIngestor, make_lines
+from backend.orders.lookups import load_index
+from backend.orders.models import CustomerProduct, TradePoint
+from backend.orders.tests.factories import CustomerFactory, CustomerOrderFactory, TradePointFactory
+
+pytestmark = pytest.mark.django_db
+
+
+def test_index_is_cached(django_assert_num_queries):
+    tp = TradePointFactory(name="Магазин")
+    load_index(TradePoint, tp.customer_id, ("name",))
+
+    with django_assert_num_queries(0):
+        assert load_index(TradePoint, tp.customer_id, ("name",)) == {("Магазин",): tp.pk}
+
+
+def test_save_and_delete_invalidate_index(django_capture_on_commit_callbacks):
+    customer = CustomerFactory()
+    assert load_index(TradePoint, customer.pk, ("name",)) == {}
+
+    with django_capture_on_commit_callbacks(execute=True):
+        tp = TradePointFactory(customer=customer, name="Магазин")
+    assert load_index(TradePoint, customer.pk, ("name",)) == {("Магазин",): tp.pk}
+
+    with django_capture_on_commit_callbacks(execute=True):
+        tp.delete()
+    assert load_index(TradePoint, customer.pk, ("name",)) == {}
+
+
+def test_ingest_invalidates_index_for_created_objects(django_capture_on_commit_callbacks):
+    customer_order = CustomerOrderFactory()
+    customer = customer_order.customer
+    load_index(CustomerProduct, customer.pk, ("name", "vendor_code"))
+    lines = make_lines([{TRADE_POINT: "Магазин", PRODUCT: "Хлеб", VENDOR_CODE: "1", AMOUNT: 2}])
+
+    with django_capture_on_commit_callbacks(execute=True):
+        OrderIngestor(customer_order).ingest(lines)
+
+    product = CustomerProduct.objects.get(customer=customer)
+    assert load_index(CustomerProduct, customer.pk, ("name", "vendor_code")) == {("Хлеб", "1"): product.pk}
+
+
+def test_ingest_with_warm_index_does_not_query_lookups(
+    django_assert_max_num_queries, django_capture_on_commit_callbacks
+):
+    customer_order = CustomerOrderFactory()
+    lines = make_lines(
+        {TRADE_POINT: f"Магазин {tp}", PRODUCT: f"Товар {i}", VENDOR_CODE: str(i), AMOUNT: 1}
+        for tp in range(5)
+        for i in range(10)
+    )
+    with django_capture_on_commit_callbacks(execute=True):
+        OrderIngestor(customer_order).ingest(lines)
+    other_order = CustomerOrderFactory(customer=customer_order.customer)
+    load_index(TradePoint, other_order.customer_id, ("name",))
+    load_index(CustomerProduct, other_order.customer_id, ("name", "vendor_code"))
+
+    # Только заказы, товары в заказе и привязка товаров к заказу клиента
+    with django_assert_max_num_queries(4):
+        OrderIngestor(other_order).ingest(lines)
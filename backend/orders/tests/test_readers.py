@@ -0,0 +1,103 @@
+import io
+
+import pytest
+
+from backend.orders.readers import (
+    CALAMINE,
+    CELL_BYTES,
+    OPENPYXL,
+    OpenpyxlReader,
+    get_reader,
+    iter_sheet,
+    read_sheet,
+)
+from backend.orders.tests.factories import make_xlsx
+
+engines = pytest.mark.parametrize("engine", [OPENPYXL, CALAMINE])
+
+
+@engines
+def test_read_sheet_fills_blanks_and_trims_trailing_rows(engine):
+    file = io.BytesIO(
+        make_xlsx(
+            [
+                ["title"],
+                ["Артикул", None, "Магазин"],
+                [101.0, "Товар", None],
+                [None, None, None],
+                [102, "Ещё", 3],
+                [None, None, None],
+                [None, None, None],
+            ]
+        )
+    )
+
+    sheet = read_sheet(file, lambda rows: 1, reader=get_reader(engine))
+
+    assert sheet.header.values.tolist() == [["Артикул", 0, "Магазин"]]
+    # Пустые строки между данными остаются, в конце листа - отбрасываются
+    assert sheet.data.values.tolist() == [[101, "Товар", 0], [0, 0, 0], [102, "Ещё", 3]]
+
+
+@engines
+def test_read_sheet_reads_file_once(engine, monkeypatch):
+    file = io.BytesIO(
+        make_xlsx([["Заказ"], [None], ["Товар", "ТТ 1", "ТТ 2"], ["Хлеб", 1, None], ["Соль", None, 2, "лишнее"]])
+    )
+    reader = get_reader(engine)
+    calls = []
+    iter_rows = reader.iter_rows
+
+    def counting_iter_rows(*args):
+        calls.append(args)
+        return iter_rows(*args)
+
+    monkeypatch.setattr(reader, "iter_rows", counting_iter_rows)
+
+    sheet = read_sheet(file, lambda rows: next(i for i, row in enumerate(rows) if "Товар" in row), reader=reader)
+
+    assert len(calls) == 1
+    assert sheet.head[0][0] == "Заказ"
+    assert sheet.header.values.tolist() == [["Товар", "ТТ 1", "ТТ 2", 0]]
+    assert sheet.data.values.tolist() == [["Хлеб", 1, 0, 0], ["Соль", 0, 2, "лишнее"]]
+
+
+def test_iter_sheet_chunks():
+    file = io.BytesIO(make_xlsx([["a", "b"], [1, 2], [3, 4], [5, 6]]))
+
+    # Бюджет на две строки по две ячейки
+    chunks = list(iter_sheet(file, lambda rows: 0, chunk_bytes=4 * CELL_BYTES))
+
+    assert [chunk.data.values.tolist() for chunk in chunks] == [[[1, 2], [3, 4]], [[5, 6]]]
+    assert all(chunk.header.values.tolist() == [["a", "b"]] for chunk in chunks)
+
+
+def test_iter_sheet_chunk_rows_within_memory_budget():
+    file = io.BytesIO(make_xlsx([["a", "b"], [1, 2], [3, 4], [5, 6]]))
+
+    # Части по две строки, хотя бюджет памяти позволяет три
+    chunks = list(iter_sheet(file, lambda rows: 0, chunk_bytes=6 * CELL_BYTES, chunk_rows=2))
+
+    assert [chunk.data.values.tolist() for chunk in chunks] == [[[1, 2], [3, 4]], [[5, 6]]]
+
+
+def test_calamine_counts_rows_and_columns_from_a1():
+    content = make_xlsx([[], [], [None, None, "Товар"], [], [None, None, None, 2]])
+
+    rows = list(get_reader(CALAMINE).iter_rows(io.BytesIO(content), skiprows=2))
+
+    assert rows == [(None, None, "Товар", None), (None,) * 4, (None, None, None, 2)]
+    # openpyxl не дополняет строки справа, но значения стоят в тех же колонках
+    expected = list(get_reader(OPENPYXL).iter_rows(io.BytesIO(content), skiprows=2))
+    assert [row[: len(other)] for row, other in zip(rows, expected)] == expected
+
+
+def test_get_reader_falls_back_to_openpyxl(monkeypatch):
+    monkeypatch.setattr("backend.orders.readers.python_calamine", None)
+
+    assert isinstance(get_reader(CALAMINE), OpenpyxlReader)
+
+
+def test_get_reader_unknown_engine():
+    with pytest.raises(ValueError):
+        get_reader("xlrd")
@@ -0,0 +1,255 @@
+import os
+
+import billiard
+import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+from django.core.files.base import ContentFile
+
+from backend.orders.ingestion import OrderIngestor
+from backend.orders.models import CustomerOrder, ProductInOrder
+from backend.orders.services import ParserFactory, map_in_processes, parse_customer_order, reingest_customer_order
+from backend.orders.tasks import create_customer_order_task
+from backend.orders.tests.factories import (
+    OSENI,
+    STROITORGOVLYA,
+    CustomerFactory,
+    CustomerOrderFactory,
+    make_xlsx,
+    make_zip,
+    order_lines,
+)
+
+pytestmark = pytest.mark.django_db
+
+
+def _parse(code: str, content: bytes, filename: str = "order.xlsx"):
+    customer = CustomerFactory(code=code)
+    customer_order = CustomerOrderFactory(customer=customer, file=ContentFile(content, name=filename))
+    ParserFactory().create_parser(code)(customer_order).parse()
+    return customer_order
+
+
+KRUASAN: list[list] = [
+    ["Напитки", "Центр", "Север"],
+    [None, "Кофейня 1", "Кофейня 2"],
+    [None, "S1", "S2"],
+    ["Латте", 2, None],
+    ["Капучино ", 1, 7],
+]
+
+PRODSTARR: list[list] = [
+    ["Отчёт"],
+    [],
+    [],
+    [],
+    [],
+    ["Контрагент", "a", "b", "c", "d", "Склад 1", "Склад 2"],
+    ["Итого", 0, 0, 0, 0, 10, 1],
+    ["Молоко", 0, 0, 0, 0, 10, None],
+    ["Кефир", 0, 0, 0, 0, None, 1],
+]
+
+
+def _bahus_file(tp: str, rows: list[list]) -> bytes:
+    header: list[list] = [[None], [None], [None], [None, None, None, f'ООО "{tp}"'], [None], [None]]
+    return make_xlsx(header + [["Артикул", "Товар", "Кол-во"]] + rows + [[None, None, None]])
+
+
+@pytest.mark.parametrize("staging", [True, False])
+def test_stroitorgovlya_parser(settings, staging):
+    settings.ORDER_INGEST_STAGING = staging
+    customer_order = _parse("stroytorgovlya", make_xlsx(STROITORGOVLYA))
+
+    assert order_lines(customer_order) == {("Магазин 1", "Цемент", 5), ("Магазин 2", "Песок", 3)}
+    assert customer_order.customer.products.count() == 3
+    assert customer_order.products.count() == 2
+
+
+@pytest.mark.parametrize("staging", [True, False])
+def test_oseni_parser(settings, staging):
+    settings.ORDER_INGEST_STAGING = staging
+    customer_order = _parse("oseni", make_xlsx(OSENI))
+
+    assert order_lines(customer_order) == {("Осень 1", "Яблоки", 4), ("Осень 2", "Яблоки", 2)}
+    assert set(customer_order.customer.products.values_list("name", "vendor_code")) == {
+        ("Яблоки", "101"),
+        ("Груши", "102"),
+    }
+    # Товары с нулевым количеством тоже привязываются к общему заказу
+    assert set(customer_order.products.values_list("name", flat=True)) == {"Яблоки", "Груши"}
+
+
+def test_kruasan_parser():
+    customer_order = _parse("kruasan", make_xlsx(KRUASAN))
+
+    assert order_lines(customer_order) == {
+        ("Кофейня 1 (Центр)", "Латте", 2),
+        ("Кофейня 1 (Центр)", "Капучино", 1),
+        ("Кофейня 2 (Север)", "Капучино", 7),
+    }
+    assert set(customer_order.customer.trade_points.values_list("sapcode", flat=True)) == {"S1", "S2"}
+
+
+def test_prodstarr_parser():
+    customer_order = _parse("prodstarr", make_xlsx(PRODSTARR))
+
+    assert order_lines(customer_order) == {("Склад 1", "Молоко", 10), ("Склад 2", "Кефир", 1)}
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_bahus_parser(settings, processes):
+    settings.ORDER_PARSE_PROCESSES = processes
+    archive = make_zip(
+        {
+            "1.xlsx": _bahus_file("Лавка 1", [["A1", "Вино", 3], ["A2", "Сыр", 0]]),
+            "2.xlsx": _bahus_file("Лавка 2", [["A1", "Вино", 1]]),
+        }
+    )
+    customer_order = _parse("lavki-bakhusa", archive, filename="order.zip")
+
+    assert order_lines(customer_order) == {("Лавка 1", "Вино", 3), ("Лавка 2", "Вино", 1)}
+    assert customer_order.customer.products.count() == 2
+
+
+def _job_pid(job: int) -> int:
+    return os.getpid()
+
+
+def _map_in_worker(jobs: int) -> tuple[int, list[int]]:
+    return os.getpid(), list(map_in_processes(_job_pid, [(job,) for job in range(jobs)], 2))
+
+
+def test_map_in_processes_inside_daemonic_worker():
+    # Процесс пула prefork воркера Celery демонический, но пул billiard из него запускается
+    with billiard.Pool(1) as pool:
+        worker_pid, pids = pool.apply(_map_in_worker, (4,))
+
+    assert len(pids) == 4
+    assert worker_pid not in pids
+
+
+def test_map_in_processes_yields_results_as_they_are_ready():
+    parsed: list[int] = []
+    results = map_in_processes(parsed.append, [(1,), (2,), (3,)], 1)
+
+    # Первый файл архива записывается, не дожидаясь разбора остальных
+    next(results)
+    assert parsed == [1]
+
+
+@pytest.mark.parametrize(
+    "code, rows, expected",
+    [
+        ("stroytorgovlya", STROITORGOVLYA, {("Магазин 1", "Цемент", 5), ("Магазин 2", "Песок", 3)}),
+        ("oseni", OSENI, {("Осень 1", "Яблоки", 4), ("Осень 2", "Яблоки", 2)}),
+        ("prodstarr", PRODSTARR, {("Склад 1", "Молоко", 10), ("Склад 2", "Кефир", 1)}),
+    ],
+)
+def test_chunked_parse_gives_same_result(settings, code, rows, expected):
+    # По одной строке в части
+    settings.ORDER_CHUNK_ROWS = 1
+
+    assert order_lines(_parse(code, make_xlsx(rows))) == expected
+
+
+def test_failed_parse_removes_written_chunks(settings, monkeypatch):
+    settings.ORDER_CHUNK_ROWS = 1
+    ingest = OrderIngestor.ingest
+    calls = []
+
+    def failing_ingest(self, lines):
+        calls.append(lines)
+        if len(calls) > 1:
+            raise RuntimeError("Ошибка записи")
+        return ingest(self, lines)
+
+    monkeypatch.setattr(OrderIngestor, "ingest", failing_ingest)
+    customer = CustomerFactory(code="stroytorgovlya")
+    customer_order = CustomerOrderFactory(
+        customer=customer, file=ContentFile(make_xlsx(STROITORGOVLYA), name="order.xlsx")
+    )
+
+    with pytest.raises(RuntimeError):
+        parse_customer_order(customer_order)
+
+    assert customer_order.status == CustomerOrder.Status.FAILED
+    assert not customer_order.tp_orders.exists()
+    assert not customer_order.products.exists()
+
+
+def test_unknown_customer_code():
+    with pytest.raises(ValueError):
+        ParserFactory().create_parser("unknown")
+
+
+def test_interrupted_parse_resumes_without_duplicates(settings, monkeypatch):
+    settings.ORDER_CHUNK_ROWS = 1
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    ingest = OrderIngestor.ingest
+    calls = []
+
+    def interrupted_ingest(self, lines):
+        calls.append(lines)
+        # Лимит времени срабатывает один раз, посреди файла
+        if len(calls) == 2:
+            raise SoftTimeLimitExceeded()
+        return ingest(self, lines)
+
+    monkeypatch.setattr(OrderIngestor, "ingest", interrupted_ingest)
+    customer = CustomerFactory(code="stroytorgovlya")
+    customer_order = CustomerOrderFactory(
+        customer=customer, file=ContentFile(make_xlsx(STROITORGOVLYA), name="order.xlsx")
+    )
+
+    create_customer_order_task.apply(args=(customer_order.pk,))
+
+    customer_order.refresh_from_db()
+    assert customer_order.status == CustomerOrder.Status.DONE
+    assert customer_order.lines_count == 2
+    assert customer_order.orders_count == 2
+    assert order_lines(customer_order) == {("Магазин 1", "Цемент", 5), ("Магазин 2", "Песок", 3)}
+    assert ProductInOrder.objects.filter(order__customer_order=customer_order).count() == 2
+
+
+def test_reingest_changes_only_changed_lines():
+    customer_order = _parse("stroytorgovlya", make_xlsx(STROITORGOVLYA))
+    rows = ProductInOrder.objects.filter(order__customer_order=customer_order)
+    ids = dict(rows.values_list("product__name", "id"))
+    corrected: list[list] = [
+        ["Заказ"],
+        ["Артикул", "Второе наименование товара", "Магазин 1", "Магазин 2"],
+        ["001", "Цемент", 5, None],
+        ["002", "Песок", None, 4],
+        ["004", "Щебень", None, 1],
+    ]
+    customer_order.file = ContentFile(make_xlsx(corrected), name="corrected.xlsx")
+    customer_order.save()
+
+    assert reingest_customer_order(customer_order) == {"inserted": 1, "updated": 1, "deleted": 0}
+    assert order_lines(customer_order) == {
+        ("Магазин 1", "Цемент", 5),
+        ("Магазин 2", "Песок", 4),
+        ("Магазин 2", "Щебень", 1),
+    }
+    # Неизменённые и изменённые строки остались теми же записями
+    assert rows.get(product__name="Цемент").id == ids["Цемент"]
+    assert rows.get(product__name="Песок").id == ids["Песок"]
+    assert customer_order.status == CustomerOrder.Status.DONE
+    assert customer_order.lines_count == 3
+    assert set(customer_order.products.values_list("name", flat=True)) == {"Цемент", "Песок", "Щебень"}
+
+
+def test_reingest_removes_missing_lines_and_orders():
+    customer_order = _parse("stroytorgovlya", make_xlsx(STROITORGOVLYA))
+    corrected: list[list] = [
+        ["Заказ"],
+        ["Артикул", "Второе наименование товара", "Магазин 1", "Магазин 2"],
+        ["001", "Цемент", 6, None],
+    ]
+    customer_order.file = ContentFile(make_xlsx(corrected), name="corrected.xlsx")
+    customer_order.save()
+
+    assert reingest_customer_order(customer_order) == {"inserted": 0, "updated": 1, "deleted": 1}
+    assert order_lines(customer_order) == {("Магазин 1", "Цемент", 6)}
+    assert list(customer_order.tp_orders.values_list("trade_point__name", flat=True)) == ["Магазин 1"]
+    assert list(customer_order.products.values_list("name", flat=True)) == ["Цемент"]
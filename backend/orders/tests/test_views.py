@@ -0,0 +1,418 @@
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from backend.orders.ingestion import AMOUNT, PRODUCT, TRADE_POINT, VENDOR_CODE, OrderIngestor, make_lines
+from backend.orders.models import CustomerOrder, CustomerProduct, TradePoint
+from backend.orders.tests.factories import (
+    STROITORGOVLYA,
+    CustomerFactory,
+    CustomerOrderFactory,
+    CustomerProductFactory,
+    ProductFactory,
+    TradePointFactory,
+    make_xlsx,
+)
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def api_client() -> APIClient:
+    return APIClient()
+
+
+def _upload(api_client, customer, content: bytes, **extra):
+    return api_client.post(
+        reverse("api:orders:customer-orders-list"),
+        {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", content)},
+        format="multipart",
+        **extra,
+    )
+
+
+def test_upload_is_parsed_in_task(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = _upload(api_client, customer, make_xlsx(STROITORGOVLYA))
+
+    assert response.status_code == 201
+    assert response.data["status"] == CustomerOrder.Status.QUEUED
+    assert response.data["task_id"]
+
+    response = api_client.get(reverse("api:orders:customer-orders-status", args=[response.data["id"]]))
+    assert response.data["status"] == CustomerOrder.Status.DONE
+    assert response.data["lines_count"] == 2
+    assert response.data["orders_count"] == 2
+
+
+def test_replaced_file_is_reingested(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    with django_capture_on_commit_callbacks(execute=True):
+        response = _upload(api_client, customer, make_xlsx(STROITORGOVLYA))
+    corrected = [row[:] for row in STROITORGOVLYA]
+    corrected[3][3] = 8
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = api_client.patch(
+            reverse("api:orders:customer-orders-detail", args=[response.data["id"]]),
+            {"file": SimpleUploadedFile("order.xlsx", make_xlsx(corrected))},
+            format="multipart",
+        )
+
+    assert response.status_code == 200
+    customer_order = CustomerOrder.objects.get(pk=response.data["id"])
+    assert customer_order.status == CustomerOrder.Status.DONE
+    assert customer_order.task_id == response.data["task_id"]
+    assert set(customer_order.tp_orders.values_list("trade_point__name", "productinorder__amount")) == {
+        ("Магазин 1", 5),
+        ("Магазин 2", 8),
+    }
+
+
+@pytest.mark.parametrize("order_status", [CustomerOrder.Status.QUEUED, CustomerOrder.Status.RUNNING])
+def test_file_is_not_replaced_during_parse(api_client, order_status, django_capture_on_commit_callbacks):
+    customer_order = CustomerOrderFactory(customer=CustomerFactory(code="stroytorgovlya"), status=order_status)
+    file_name = customer_order.file.name
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = api_client.patch(
+            reverse("api:orders:customer-orders-detail", args=[customer_order.pk]),
+            {"file": SimpleUploadedFile("order.xlsx", make_xlsx(STROITORGOVLYA))},
+            format="multipart",
+        )
+
+    assert response.status_code == 400
+    assert "file" in response.data
+    assert not callbacks
+    customer_order.refresh_from_db()
+    assert customer_order.status == order_status
+    assert customer_order.file.name == file_name
+
+
+def test_failed_parse_is_reported(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    settings.CELERY_TASK_EAGER_PROPAGATES = False
+    customer = CustomerFactory(code="stroytorgovlya")
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = _upload(api_client, customer, b"not a workbook")
+
+    response = api_client.get(reverse("api:orders:customer-orders-status", args=[response.data["id"]]))
+    assert response.data["status"] == CustomerOrder.Status.FAILED
+    assert response.data["error"]
+
+
+def test_duplicate_upload_is_not_parsed_again(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    content = make_xlsx(STROITORGOVLYA)
+    with django_capture_on_commit_callbacks(execute=True):
+        first = _upload(api_client, customer, content)
+
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        response = _upload(api_client, customer, content)
+
+    assert response.status_code == 200
+    assert response.data["id"] == first.data["id"]
+    assert not callbacks
+    assert CustomerOrder.objects.filter(customer=customer).count() == 1
+
+
+def test_duplicate_upload_relink(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    content = make_xlsx(STROITORGOVLYA)
+    with django_capture_on_commit_callbacks(execute=True):
+        first = _upload(api_client, customer, content)
+
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        response = api_client.post(
+            reverse("api:orders:customer-orders-list") + "?relink=1",
+            {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", content)},
+            format="multipart",
+        )
+
+    assert response.status_code == 201
+    assert not callbacks
+    source = CustomerOrder.objects.get(pk=first.data["id"])
+    relinked = CustomerOrder.objects.get(pk=response.data["id"])
+    assert relinked.status == CustomerOrder.Status.DONE
+    assert relinked.file_hash == source.file_hash
+    assert set(
+        relinked.tp_orders.values_list("trade_point", "productinorder__product", "productinorder__amount")
+    ) == set(source.tp_orders.values_list("trade_point", "productinorder__product", "productinorder__amount"))
+
+
+def test_duplicate_upload_relink_off(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    content = make_xlsx(STROITORGOVLYA)
+    with django_capture_on_commit_callbacks(execute=True):
+        first = _upload(api_client, customer, content)
+
+    response = api_client.post(
+        reverse("api:orders:customer-orders-list") + "?relink=0",
+        {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", content)},
+        format="multipart",
+    )
+
+    assert response.status_code == 200
+    assert response.data["id"] == first.data["id"]
+    assert CustomerOrder.objects.filter(customer=customer).count() == 1
+
+
+def test_idempotent_upload_is_replayed(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    with django_capture_on_commit_callbacks(execute=True):
+        first = _upload(api_client, customer, make_xlsx(STROITORGOVLYA), HTTP_IDEMPOTENCY_KEY="upload-1")
+
+    # Повтор после таймаута: файл другой, но ключ тот же
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        response = _upload(api_client, customer, b"retry", HTTP_IDEMPOTENCY_KEY="upload-1")
+
+    assert response.status_code == 201
+    assert response["Idempotent-Replayed"] == "true"
+    assert response.data["id"] == first.data["id"]
+    assert response.data["status"] == CustomerOrder.Status.DONE
+    assert not callbacks
+    assert CustomerOrder.objects.filter(customer=customer).count() == 1
+
+
+def test_idempotent_duplicate_upload_is_answered_again(api_client, settings, django_capture_on_commit_callbacks):
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    customer = CustomerFactory(code="stroytorgovlya")
+    content = make_xlsx(STROITORGOVLYA)
+    with django_capture_on_commit_callbacks(execute=True):
+        first = _upload(api_client, customer, content)
+
+    # Файл уже загружен: ответ 200, ключ не сохраняется, и повтор получает тот же ответ
+    responses = [_upload(api_client, customer, content, HTTP_IDEMPOTENCY_KEY="upload-1") for _ in range(2)]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    assert all(response.data["id"] == first.data["id"] for response in responses)
+    assert all("Idempotent-Replayed" not in response for response in responses)
+    assert CustomerOrder.objects.filter(customer=customer).count() == 1
+
+
+def test_idempotency_key_is_scoped_to_customer(api_client, django_capture_on_commit_callbacks):
+    other = CustomerOrderFactory(customer=CustomerFactory(code="oseni"), idempotency_key="upload-1")
+    customer = CustomerFactory(code="stroytorgovlya")
+
+    with django_capture_on_commit_callbacks():
+        response = _upload(api_client, customer, make_xlsx(STROITORGOVLYA), HTTP_IDEMPOTENCY_KEY="upload-1")
+
+    # Ключи разных клиентов независимы
+    assert response.status_code == 201
+    assert "Idempotent-Replayed" not in response
+    assert response.data["id"] != other.pk
+    assert CustomerOrder.objects.get(pk=response.data["id"]).customer == customer
+
+
+def test_idempotency_key_race(api_client, monkeypatch):
+    customer = CustomerFactory(code="stroytorgovlya")
+    # Параллельный запрос создал заказ с тем же ключом уже после проверки
+    existing = CustomerOrderFactory(customer=customer, idempotency_key="upload-1")
+    monkeypatch.setattr(
+        "backend.orders.views.CustomerOrder.objects.filter",
+        lambda **kwargs: CustomerOrder.objects.none(),
+    )
+
+    response = _upload(api_client, customer, make_xlsx(STROITORGOVLYA), HTTP_IDEMPOTENCY_KEY="upload-1")
+
+    assert response.status_code == 201
+    assert response.data["id"] == existing.pk
+
+
+def test_dry_run_returns_summary_without_writes(api_client, django_capture_on_commit_callbacks):
+    customer = CustomerFactory(code="stroytorgovlya")
+    TradePointFactory(customer=customer, name="Магазин 1")
+    CustomerProductFactory(customer=customer, name="Цемент", vendor_code="001")
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = api_client.post(
+            reverse("api:orders:customer-orders-list") + "?dry_run=1",
+            {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", make_xlsx(STROITORGOVLYA))},
+            format="multipart",
+        )
+
+    assert response.status_code == 200
+    assert response.data["lines_count"] == 2
+    assert [dict(tp) for tp in response.data["trade_points"]] == [
+        {"name": "Магазин 1", "sapcode": "", "known": True, "lines_count": 1, "amount": 5},
+        {"name": "Магазин 2", "sapcode": "", "known": False, "lines_count": 1, "amount": 3},
+    ]
+    assert response.data["products_count"] == 3
+    assert response.data["new_products_count"] == 2
+    assert response.data["new_products"] == ["Песок", "Гравий"]
+    assert not callbacks
+    assert not CustomerOrder.objects.exists()
+    assert TradePoint.objects.filter(customer=customer).count() == 1
+
+
+@pytest.mark.parametrize("value", ["0", "false"])
+def test_dry_run_off_uploads_file(api_client, value, django_capture_on_commit_callbacks):
+    customer = CustomerFactory(code="stroytorgovlya")
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = api_client.post(
+            reverse("api:orders:customer-orders-list") + f"?dry_run={value}",
+            {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", make_xlsx(STROITORGOVLYA))},
+            format="multipart",
+        )
+
+    assert response.status_code == 201
+    assert CustomerOrder.objects.filter(pk=response.data["id"]).exists()
+    assert len(callbacks) == 1
+
+
+def test_dry_run_reports_parse_error(api_client):
+    customer = CustomerFactory(code="stroytorgovlya")
+
+    response = api_client.post(
+        reverse("api:orders:customer-orders-list") + "?dry_run=1",
+        {"customer": customer.pk, "file": SimpleUploadedFile("order.xlsx", make_xlsx([["Нет шапки"], [1]]))},
+        format="multipart",
+    )
+
+    assert response.status_code == 400
+    assert "file" in response.data
+
+
+def test_orders_list_query_count(api_client, django_assert_num_queries):
+    customer_order = CustomerOrderFactory()
+    lines = make_lines(
+        {TRADE_POINT: f"Магазин {tp}", PRODUCT: f"Товар {i}", VENDOR_CODE: str(i), AMOUNT: i + 1}
+        for tp in range(10)
+        for i in range(5)
+    )
+    OrderIngestor(customer_order).ingest(lines)
+    CustomerProduct.objects.filter(vendor_code__in=["0", "1"]).update(base_product=ProductFactory())
+
+    # Заказы с торговыми точками и строки с товарами, независимо от числа заказов и строк,
+    # плюс проверка фильтра customer_order и точка сохранения ATOMIC_REQUESTS
+    with django_assert_num_queries(5):
+        response = api_client.get(reverse("api:orders:orders-list"), {"customer_order": customer_order.pk})
+
+    assert response.status_code == 200
+    orders = response.data["results"]
+    assert len(orders) == 10
+    assert orders[0]["trade_point_name"] == "Магазин 0"
+    assert [line["amount"] for line in orders[0]["products_list"]] == [1, 2, 3, 4, 5]
+    assert orders[0]["products_list"][0]["amount_in_pack"] == 6
+    assert orders[0]["products_list"][2]["base_product_name"] == ""
+
+
+def test_customers_list_query_count(api_client, django_assert_num_queries):
+    customers = [CustomerFactory() for _ in range(5)]
+    for customer in customers:
+        TradePointFactory.create_batch(3, customer=customer)
+        CustomerOrderFactory.create_batch(2, customer=customer)
+    empty = CustomerFactory()
+    last_order = CustomerOrderFactory(customer=customers[0], lines_count=7)
+    last_order.products.add(CustomerProductFactory(customer=customers[0]))
+
+    # Клиенты с числом торговых точек и последние заказы, плюс точка сохранения ATOMIC_REQUESTS
+    with django_assert_num_queries(4):
+        response = api_client.get(reverse("api:orders:customers-list"))
+
+    assert response.status_code == 200
+    data = {customer["id"]: customer for customer in response.data}
+    assert data[customers[0].pk]["tp_count"] == 3
+    assert data[customers[0].pk]["last_order"]["id"] == last_order.pk
+    assert data[customers[0].pk]["last_order"]["lines_count"] == 7
+    assert "products" not in data[customers[0].pk]["last_order"]
+    assert data[empty.pk]["tp_count"] == 0
+    assert data[empty.pk]["last_order"] is None
+
+
+def test_customer_orders_cursor_pagination(api_client):
+    customer = CustomerFactory()
+    customer_orders = CustomerOrderFactory.create_batch(5, customer=customer)
+    url = reverse("api:orders:customer-orders-list") + "?page_size=2"
+
+    ids = []
+    while url:
+        response = api_client.get(url)
+        assert response.status_code == 200
+        assert len(response.data["results"]) <= 2
+        ids += [customer_order["id"] for customer_order in response.data["results"]]
+        url = response.data["next"]
+
+    assert ids == [customer_order.pk for customer_order in reversed(customer_orders)]
+
+
+def test_customer_orders_list_has_product_counts(api_client, django_assert_num_queries):
+    empty = CustomerOrderFactory()
+    customer_order = CustomerOrderFactory()
+    products = CustomerProductFactory.create_batch(4, customer=customer_order.customer)
+    products[0].base_product = ProductFactory()
+    products[0].save()
+    customer_order.products.add(*products)
+
+    # Заказы с количеством товаров, плюс точка сохранения ATOMIC_REQUESTS
+    with django_assert_num_queries(3):
+        response = api_client.get(reverse("api:orders:customer-orders-list"))
+
+    data, empty_data = response.data["results"]
+    assert "products" not in data
+    assert data["products_count"] == 4
+    assert data["unmapped_products_count"] == 3
+    assert empty_data["id"] == empty.pk
+    assert empty_data["products_count"] == empty_data["unmapped_products_count"] == 0
+
+
+def test_customer_order_products(api_client):
+    customer_order = CustomerOrderFactory()
+    products = CustomerProductFactory.create_batch(5, customer=customer_order.customer)
+    products[0].base_product = ProductFactory()
+    products[0].save()
+    customer_order.products.add(*products)
+    url = reverse("api:orders:customer-orders-products", args=[customer_order.pk])
+
+    response = api_client.get(url, {"page_size": 3})
+    assert [product["id"] for product in response.data["results"]] == [product.pk for product in products[:3]]
+    assert response.data["results"][0]["base_product"]["id"] == products[0].base_product_id
+    response = api_client.get(response.data["next"])
+    assert [product["id"] for product in response.data["results"]] == [product.pk for product in products[3:]]
+
+    response = api_client.get(url, {"unmapped": 1})
+    assert [product["id"] for product in response.data["results"]] == [product.pk for product in products[1:]]
+    response = api_client.get(url, {"unmapped": 0})
+    assert [product["id"] for product in response.data["results"]] == [product.pk for product in products]
+
+
+def test_customer_order_matrix(api_client, django_assert_num_queries):
+    customer_order = CustomerOrderFactory()
+    lines = make_lines(
+        [
+            {TRADE_POINT: "Магазин 2", PRODUCT: "Хлеб", VENDOR_CODE: "1", AMOUNT: 2},
+            {TRADE_POINT: "Магазин 1", PRODUCT: "Молоко", VENDOR_CODE: "2", AMOUNT: 3},
+            {TRADE_POINT: "Магазин 1", PRODUCT: "Хлеб", VENDOR_CODE: "1", AMOUNT: 1},
+            # Повтор строки в файле складывается в одну ячейку
+            {TRADE_POINT: "Магазин 1", PRODUCT: "Хлеб", VENDOR_CODE: "1", AMOUNT: 4},
+        ]
+    )
+    OrderIngestor(customer_order).ingest(lines)
+    CustomerProduct.objects.filter(vendor_code="2").update(base_product=ProductFactory(name="Молоко 1л"))
+    url = reverse("api:orders:customer-orders-matrix", args=[customer_order.pk])
+
+    # Заказ и строки одним агрегирующим запросом, плюс точка сохранения ATOMIC_REQUESTS
+    with django_assert_num_queries(4):
+        response = api_client.get(url)
+
+    assert [trade_point["name"] for trade_point in response.data["trade_points"]] == ["Магазин 1", "Магазин 2"]
+    assert [product["product_name"] for product in response.data["products"]] == ["Молоко", "Хлеб"]
+    assert response.data["products"][0]["base_product_name"] == "Молоко 1л"
+    assert response.data["products"][1]["base_product_name"] == ""
+    assert response.data["amounts"] == [[0, 0, 3], [0, 1, 5], [1, 1, 2]]
+
+    response = api_client.get(url, {"dense": 1})
+    assert response.data["amounts"] == [[3, 5], [0, 2]]
+    response = api_client.get(url, {"dense": 0})
+    assert response.data["amounts"] == [[0, 0, 3], [0, 1, 5], [1, 1, 2]]
@@ -0,0 +1,38 @@
+import hashlib
+
+from django.core.files.uploadhandler import FileUploadHandler
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Sha256UploadHandler(FileUploadHandler):
+    """
+    Считает SHA-256 загружаемых файлов по мере получения частей запроса.
+    Сами данные передаются дальше без изменений, файл сохраняют следующие обработчики.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.hashes: dict[str, str] = {}
+        self._sha256 = hashlib.sha256()
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self._sha256.update(raw_data)
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.hashes[self.field_name] = self._sha256.hexdigest()
+        return None
+
+
+def file_sha256(file) -> str:
+    """SHA-256 уже загруженного файла, если хеш не был посчитан при получении."""
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks(CHUNK_SIZE):
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
@@ -1,10 +1,16 @@
-from django.db import transaction
+from uuid import uuid4
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Func, IntegerField, OuterRef, Prefetch, QuerySet, Subquery
 
 # from django.db.models.query import QuerySet
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 
 # from loguru import logger as log
-from rest_framework import filters, viewsets  # status
+from rest_framework import filters, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 
 # from rest_framework.permissions import IsAuthenticated
 from backend.orders.models import (
@@ -13,24 +19,53 @@ from backend.orders.models import (
     CustomerProduct,
     Order,
     Product,
+    ProductInOrder,
     TradePoint,
 )
+from backend.orders.pagination import CreatedCursorPagination, IdCursorPagination
 from backend.orders.serializers import (
+    CustomerOrderListSerializer,
+    CustomerOrderMatrixSerializer,
+    CustomerOrderPreviewSerializer,
     CustomerOrderSerializer,
+    CustomerOrderStatusSerializer,
     CustomerProductSerializer,
     CustomerSerializer,
     OrderSerializer,
     ProductSerializer,
     TradePointSerializer,
 )
-from backend.orders.services import ParserFactory
+from backend.orders.services import (
+    build_order_matrix,
+    find_duplicate_customer_order,
+    preview_customer_order,
+    relink_customer_order,
+)
+from backend.orders.tasks import create_customer_order_task, reingest_customer_order_task
+from backend.orders.uploads import Sha256UploadHandler, file_sha256
+
 
-# from backend.orders.tasks import create_customer_order_task
+def _flag(request, name: str) -> bool:
+    """Флаг из параметров запроса: ``?name=1``, ``true`` или ``yes``; остальные значения - выключен."""
+    return request.query_params.get(name, "").lower() in ("1", "true", "yes")
 
 
 @extend_schema(tags=["Customers"])
 class CustomerViewSet(viewsets.ModelViewSet):
-    queryset = Customer.objects.all()
+    # Число торговых точек и последний заказ клиентов считаются двумя запросами на всю страницу
+    queryset = Customer.objects.annotate(trade_points_count=Count("trade_points")).prefetch_related(
+        Prefetch(
+            "orders",
+            queryset=CustomerOrder.objects.filter(
+                pk=Subquery(
+                    CustomerOrder.objects.filter(customer=OuterRef("customer"))
+                    .order_by("-created", "-id")
+                    .values("pk")[:1]
+                )
+            ),
+            to_attr="last_orders",
+        )
+    )
     serializer_class = CustomerSerializer
     # permission_classes = [IsAuthenticated]
 
@@ -48,6 +83,7 @@ class CustomerViewSet(viewsets.ModelViewSet):
 class TradePointViewSet(viewsets.ModelViewSet):
     queryset = TradePoint.objects.all()
     serializer_class = TradePointSerializer
+    pagination_class = IdCursorPagination
     filterset_fields = ("customer",)
     # permission_classes = [IsAuthenticated]
 
@@ -64,6 +100,7 @@ class TradePointViewSet(viewsets.ModelViewSet):
 class ProductViewSet(viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    pagination_class = IdCursorPagination
     filter_backends = [filters.SearchFilter]
     search_fields = ["vendor_code"]
     # permission_classes = (IsAuthenticated,)
@@ -73,6 +110,7 @@ class ProductViewSet(viewsets.ModelViewSet):
 class CustomerProductViewSet(viewsets.ModelViewSet):
     queryset = CustomerProduct.objects.all()
     serializer_class = CustomerProductSerializer
+    pagination_class = IdCursorPagination
     # permission_classes = [IsAuthenticated]
 
     # def get_queryset(self) -> QuerySet:
@@ -84,10 +122,19 @@ class CustomerProductViewSet(viewsets.ModelViewSet):
     #     return super().get_queryset().filter(customer__owner=user)
 
 
+def _count(queryset: QuerySet) -> Subquery:
+    """Число строк ``queryset`` как коррелированный подзапрос, без GROUP BY во внешнем запросе."""
+    return Subquery(
+        queryset.order_by().annotate(count=Func("pk", function="COUNT")).values("count"),
+        output_field=IntegerField(),
+    )
+
+
 @extend_schema(tags=["CustomerOrders"])
 class CustomerOrderViewSet(viewsets.ModelViewSet):
     queryset = CustomerOrder.objects.prefetch_related("products", "products__base_product").order_by("-created")
     serializer_class = CustomerOrderSerializer
+    pagination_class = CreatedCursorPagination
     filterset_fields = ("customer",)
     # permission_classes = [IsAuthenticated]
 
@@ -99,22 +146,171 @@ class CustomerOrderViewSet(viewsets.ModelViewSet):
     #         return super().get_queryset()
     #     return super().get_queryset().filter(customer__owner=user)
 
+    def get_queryset(self):
+        if self.action in ("status", "products", "matrix"):
+            return CustomerOrder.objects.all()
+        if self.action == "list":
+            # Товары в списке не выводятся, только их количество. Счётчики - подзапросы
+            # по строкам страницы, а не соединение со всеми товарами всех заказов до LIMIT
+            ordered_products = CustomerOrder.products.through._default_manager.filter(customerorder=OuterRef("pk"))
+            return (
+                CustomerOrder.objects.select_related("customer")
+                .annotate(
+                    products_count=_count(ordered_products),
+                    unmapped_products_count=_count(ordered_products.filter(customerproduct__base_product__isnull=True)),
+                )
+                .order_by("-created")
+            )
+        return super().get_queryset()
+
+    def get_serializer_class(self):
+        if self.action == "list":
+            return CustomerOrderListSerializer
+        return super().get_serializer_class()
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("dry_run", bool, description="Только разобрать файл и вернуть сводку, без записи"),
+            OpenApiParameter("relink", bool, description="Перенести результат уже разобранного такого же файла"),
+        ],
+        responses={201: CustomerOrderSerializer, 200: CustomerOrderPreviewSerializer},
+    )
+    def create(self, request, *args, **kwargs):
+        if _flag(request, "dry_run"):
+            return self._preview(request)
+
+        # Хеш файла считается по мере получения загрузки
+        hasher = Sha256UploadHandler(request)
+        request.upload_handlers.insert(0, hasher)
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        customer = serializer.validated_data["customer"]
+
+        # Повтор запроса клиента с тем же Idempotency-Key возвращает созданный им заказ, файл не разбирается
+        idempotency_key = request.headers.get("Idempotency-Key", "")
+        if idempotency_key:
+            created = CustomerOrder.objects.filter(customer=customer, idempotency_key=idempotency_key).first()
+            if created is not None:
+                return self._replay(created)
+
+        file_hash = hasher.hashes.get("file") or file_sha256(serializer.validated_data["file"])
+
+        # Повторно присланный файл не разбирается: возвращается уже созданный заказ,
+        # а с ?relink=1 его результат переносится в новый заказ
+        duplicate = find_duplicate_customer_order(customer, file_hash)
+        if duplicate is not None and (
+            not _flag(request, "relink") or duplicate.status != CustomerOrder.Status.DONE
+        ):
+            return Response(self.get_serializer(duplicate).data, status=status.HTTP_200_OK)
+
+        try:
+            with transaction.atomic():
+                if duplicate is not None:
+                    instance = serializer.save(file_hash=file_hash, idempotency_key=idempotency_key)
+                    relink_customer_order(duplicate, instance)
+                else:
+                    self.perform_create(serializer, file_hash=file_hash, idempotency_key=idempotency_key)
+        except IntegrityError:
+            if not idempotency_key:
+                raise
+            # Параллельный запрос с тем же ключом успел создать заказ раньше
+            return self._replay(CustomerOrder.objects.get(customer=customer, idempotency_key=idempotency_key))
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    def _preview(self, request) -> Response:
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            summary = preview_customer_order(serializer.validated_data["customer"], serializer.validated_data["file"])
+        except Exception as e:
+            raise ValidationError({"file": [str(e)]}) from e
+        return Response(CustomerOrderPreviewSerializer(summary).data)
+
+    def _replay(self, customer_order: CustomerOrder) -> Response:
+        """
+        Ответ на повтор запроса с тем же Idempotency-Key - всегда 201: ключ
+        сохраняется только в заказе, созданном этим запросом. Ответ 200 на
+        повторно присланный файл заказ не создаёт и ключ не сохраняет, поэтому
+        повтор такого запроса снова проходит проверку на дубликат и тоже получает 200.
+        """
+        return Response(
+            self.get_serializer(customer_order).data,
+            status=status.HTTP_201_CREATED,
+            headers={"Idempotent-Replayed": "true"},
+        )
+
     @transaction.atomic
-    def perform_create(self, serializer):
-        instance = serializer.save()
-        # Распарсить файл заказа
-        factory = ParserFactory()
-        parser = factory.create_parser(instance.customer.code)(instance)
-        parser.parse()
-        # Распарсить файл заказа в таске
-        # task_id = create_customer_order_task.delay(instance.pk)
-        # log.info("task_id: {}", task_id)
+    def perform_create(self, serializer, **kwargs):
+        task_id = uuid4().hex
+        instance = serializer.save(task_id=task_id, **kwargs)
+        # Распарсить файл заказа в таске, когда файл и заказ сохранены
+        transaction.on_commit(lambda: create_customer_order_task.apply_async((instance.pk,), task_id=task_id))
+
+    @transaction.atomic
+    def perform_update(self, serializer):
+        if "file" not in serializer.validated_data:
+            return super().perform_update(serializer)
+        # Пока прежний файл в очереди или разбирается, два таска писали бы строки заказа одновременно
+        current = CustomerOrder.objects.select_for_update().get(pk=serializer.instance.pk)
+        if current.status not in (CustomerOrder.Status.DONE, CustomerOrder.Status.FAILED):
+            raise ValidationError({"file": ["Файл ещё разбирается, заменить его можно после окончания разбора."]})
+        # Заменённый файл разбирается в таске, заказы меняются только в отличающихся строках
+        task_id = uuid4().hex
+        instance = serializer.save(
+            task_id=task_id,
+            status=CustomerOrder.Status.QUEUED,
+            file_hash=file_sha256(serializer.validated_data["file"]),
+        )
+        transaction.on_commit(lambda: reingest_customer_order_task.apply_async((instance.pk,), task_id=task_id))
+
+    @extend_schema(responses=CustomerOrderStatusSerializer)
+    @action(detail=True, methods=["get"])
+    def status(self, request, pk=None):
+        serializer = CustomerOrderStatusSerializer(self.get_object())
+        return Response(serializer.data)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("unmapped", bool, description="Только товары без сопоставления с внутренней матрицей"),
+            OpenApiParameter("cursor", str, description="Курсор страницы из ссылок next и previous"),
+            OpenApiParameter("page_size", int, description="Число товаров на странице"),
+        ],
+        responses=CustomerProductSerializer(many=True),
+    )
+    @action(
+        detail=True,
+        methods=["get"],
+        serializer_class=CustomerProductSerializer,
+        pagination_class=IdCursorPagination,
+    )
+    def products(self, request, pk=None):
+        queryset = self.get_object().products.select_related("base_product")
+        if _flag(request, "unmapped"):
+            queryset = queryset.filter(base_product__isnull=True)
+        page = self.paginate_queryset(queryset)
+        return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter("dense", bool, description="Количества строками по торговым точкам, а не тройками")
+        ],
+        responses=CustomerOrderMatrixSerializer,
+    )
+    @action(detail=True, methods=["get"])
+    def matrix(self, request, pk=None):
+        matrix = build_order_matrix(self.get_object(), dense=_flag(request, "dense"))
+        return Response(CustomerOrderMatrixSerializer(matrix).data)
 
 
 @extend_schema(tags=["Orders"])
 class OrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.all()
+    # Вся страница собирается двумя запросами: заказы с торговыми точками и строки с товарами
+    queryset = Order.objects.select_related("trade_point").prefetch_related(
+        Prefetch("productinorder_set", queryset=ProductInOrder.objects.select_related("product__base_product"))
+    )
     serializer_class = OrderSerializer
+    pagination_class = IdCursorPagination
     filterset_fields = ("customer_order", "trade_point")
     http_method_names = ["get"]
     # permission_classes = [IsAuthenticated]
@@ -362,3 +362,27 @@ SPECTACULAR_SETTINGS = {
 }
 # Your stuff...
 # ------------------------------------------------------------------------------
+# Order files
+# Движок чтения xlsx по умолчанию ("openpyxl" или "calamine")
+ORDER_FILE_READER = env.str("ORDER_FILE_READER", "openpyxl")
+# Движок чтения для отдельных клиентов: код клиента -> движок
+ORDER_FILE_READERS = {
+    "prodstarr": "calamine",
+    "lavki-bakhusa": "calamine",
+}
+# Число процессов, которыми задача Celery разбирает файлы внутри архива (0 - по числу ядер, 1 - без пула).
+# Пул запускает каждая задача, разбирающая архив, поэтому при нескольких процессах воркера
+# (--concurrency) значение стоит уменьшить, чтобы в сумме не выйти за число ядер
+ORDER_PARSE_PROCESSES = env.int("ORDER_PARSE_PROCESSES", 0)
+# Память на разбор одной части файла заказа; 0 - файл разбирается целиком
+ORDER_CHUNK_BYTES = env.int("ORDER_CHUNK_BYTES", 256 * 1024 * 1024)
+# Строк в одной части файла заказа: после каждой части запоминается место, с которого
+# продолжит повторный запуск задачи; 0 - размер части ограничен только ORDER_CHUNK_BYTES
+ORDER_CHUNK_ROWS = env.int("ORDER_CHUNK_ROWS", 20_000)
+# Писать строки заказа через промежуточную таблицу и публиковать одной транзакцией в конце
+ORDER_INGEST_STAGING = env.bool("ORDER_INGEST_STAGING", True)
+# Сколько файлов одновременно разбирать при массовом повторном разборе заказов
+ORDER_REPARSE_LANES = env.int("ORDER_REPARSE_LANES", 4)
+# Размер страницы списков API заказов по умолчанию и наибольший, который можно запросить ?page_size=
+ORDER_API_PAGE_SIZE = env.int("ORDER_API_PAGE_SIZE", 100)
+ORDER_API_MAX_PAGE_SIZE = env.int("ORDER_API_MAX_PAGE_SIZE", 1000)